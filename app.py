@@ -1,38 +1,834 @@
 import openai
 import gradio as gr
+import asyncio
+import atexit
+import bisect
+import contextlib
+import contextvars
+import aiohttp
+import weakref
 import pandas as pd
 import os
 import smtplib
+import sqlite3
 import logging
+import logging.handlers
+import math
+import queue
+import random
+import hashlib
+import heapq
+import json
+import pickle
 import tiktoken
+import sys
+import threading
+import time
+import re
+import uuid
+import numpy as np
+import uvicorn
+from collections import OrderedDict, deque
 from datetime import datetime
 from dotenv import load_dotenv
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+from typing import Optional
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
-# 設置日誌記錄
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('app.log'),
-        logging.StreamHandler()
-    ]
-)
-
 # 載入環境變數
 load_dotenv()
+
+# 日誌設定
+LOG_FILE = os.getenv("LOG_FILE", "app.log")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))  # 日誌檔超過此大小即輪替
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 5))  # 保留的舊日誌檔數
+LOG_DETAIL_SAMPLE_RATE = float(os.getenv("LOG_DETAIL_SAMPLE_RATE", 0.1))  # 輸出每輪細部日誌的回合比例
+
+# 目前回合的會話編號、state 與是否輸出細部日誌，由 LogContextFilter 附加到日誌記錄
+log_context = contextvars.ContextVar("log_context", default=None)
+
+class LogContextFilter(logging.Filter):
+    """在產生日誌的執行緒上附加會話編號與流程步驟（寫檔在背景執行緒，無法取得 contextvars）"""
+
+    def filter(self, record):
+        context = log_context.get()
+        state = context["state"] if context else None
+        record.session_id = context["session_id"] if context else None
+        record.step = state.get("step") if state else None
+        return True
+
+class JsonLogFormatter(logging.Formatter):
+    """每筆日誌輸出為一行 JSON，包含會話編號、流程步驟及 extra={"fields": {...}} 傳入的欄位"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "session": getattr(record, "session_id", None),
+            "step": getattr(record, "step", None),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def setup_logging():
+    """日誌先放入佇列，由 QueueListener 在背景執行緒寫入輪替的 JSON 日誌檔及主控台"""
+    log_queue = queue.Queue()
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+    )
+    file_handler.setFormatter(JsonLogFormatter())
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    queue_handler.addFilter(LogContextFilter())
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+# 設置日誌記錄
+log_listener = setup_logging()
+
+def begin_turn_logging(session_id, state):
+    """設定本回合的日誌上下文，並依 LOG_DETAIL_SAMPLE_RATE 決定是否輸出細部日誌"""
+    log_context.set({
+        "session_id": session_id,
+        "state": state,
+        "sampled": random.random() < LOG_DETAIL_SAMPLE_RATE,
+    })
+
+def log_detail(message, **fields):
+    """每輪的細部日誌，只在抽樣到的回合輸出；回合之外一律輸出"""
+    context = log_context.get()
+    if context is None or context["sampled"]:
+        logging.info(message, extra={"fields": fields} if fields else None)
+
+def log_turn(started, source, **fields):
+    """每回合一筆摘要日誌（不抽樣），包含總耗時與來源（local / cache / model / degraded / error）"""
+    fields["total_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    fields["source"] = source
+    logging.info("回合完成", extra={"fields": fields})
+    TURN_LATENCY.observe(fields["total_ms"] / 1000, source=source)
 openai.api_key = os.getenv("OPENAI_API_KEY")
+# 可指向本地模擬伺服器進行測試
+openai.api_base = os.getenv("OPENAI_API_BASE", openai.api_base)
 
 # 全局變數
-conversation = []
-current_step = "步驟零"
-api_cost = 0.0
 system_tokens = 0  # 系統提示的 tokens
 excel_tokens = 0   # Excel 資料的 tokens
 base_tokens = 0  # 用於存儲 system prompt 和 Excel 資料的 tokens
 product_categories = {}  # 初始化產品分類字典
-system_prompt_loaded = False  # 追蹤系統提示是否已加載
+CATALOG_FILE = 'GPTdata0325.xlsx'
+CATALOG_SNAPSHOT_DIR = os.getenv("CATALOG_SNAPSHOT_DIR", ".catalog_cache")  # 產品目錄快照目錄
+CATALOG_SNAPSHOT_FORMAT = 3  # 快照內容結構變更時遞增
+catalog_version = None  # 產品目錄檔案的雜湊值
+prompt_bundles = None  # 預先渲染的提示詞組合
+product_index = None  # 產品檢索索引
+catalog = None  # 目前的產品目錄（上述資料的整體），重新載入時以單次賦值替換
+CATALOG_RELOAD_INTERVAL = float(os.getenv("CATALOG_RELOAD_INTERVAL", 30))  # 檢查產品目錄檔案變更的間隔（秒），0 表示停用
+
+# 產品檢索設定
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", 30))  # 注入提示詞的產品數上限，0 表示停用檢索
+RETRIEVAL_MIN_SCORE = float(os.getenv("RETRIEVAL_MIN_SCORE", 2.0))  # 最佳匹配低於此分數時使用完整目錄
+PROMPT_CACHE_LAYOUT = os.getenv("PROMPT_CACHE_LAYOUT", "1") != "0"  # 所有會話共用相同的系統提示前綴，分類與檢索到的產品另以聚焦消息提供
+RETRIEVAL_COLUMNS = ['產品名稱', '主要功能', '使用方式', '產品第一層分類', '產品第二層分類']
+
+# 會話設定
+SESSION_MAX_MESSAGES = int(os.getenv("SESSION_MAX_MESSAGES", 60))  # 每個會話保留的最大消息數（不含系統提示）
+SESSION_IDLE_TTL = int(os.getenv("SESSION_IDLE_TTL", 3600))  # 會話閒置超過此秒數即清除
+SESSION_MAX_COUNT = int(os.getenv("SESSION_MAX_COUNT", 1000))  # 進程內最多保留的會話數
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 1))  # worker 進程數（由 serve.py 設定），大於 1 時會話存儲由所有 worker 共用
+SESSION_SHARED = WEB_CONCURRENCY > 1
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "sessions.db" if SESSION_SHARED else "")  # 會話保存的 SQLite 檔案，空白表示只保存在記憶體
+# 背景執行緒合併寫入的最長等待秒數；多 worker 時每輪結束需等待寫入，預設不額外等待
+SESSION_DB_FLUSH_INTERVAL = float(os.getenv("SESSION_DB_FLUSH_INTERVAL", 0 if SESSION_SHARED else 0.2))
+GRADIO_CONCURRENCY = int(os.getenv("GRADIO_CONCURRENCY", 200))  # 同時處理的請求數
+HTTP_KEEP_ALIVE = int(os.getenv("HTTP_KEEP_ALIVE", 30))  # HTTP 連線閒置保持秒數，讓 API 呼叫端重複使用連線
+
+# OpenAI 呼叫設定（預設值對應 gpt-4.1-mini 的 Tier 1 限額）
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4.1-mini-2025-04-14")
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", 100))  # 同時進行的 API 請求數上限
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", 500))  # 每分鐘請求數上限
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", 200000))  # 每分鐘 tokens 上限
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", 60))  # 每次嘗試等待第一個區塊（非串流為完整回應）及區塊之間的秒數上限
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 2))  # 逾時、429 及 5xx 時的重試次數
+OPENAI_RETRY_BASE_DELAY = float(os.getenv("OPENAI_RETRY_BASE_DELAY", 0.5))  # 重試等待的基準秒數，每次加倍並隨機抖動
+OPENAI_RETRY_MAX_DELAY = float(os.getenv("OPENAI_RETRY_MAX_DELAY", 8))  # 重試等待的上限秒數（Retry-After 不受此限）
+OPENAI_HEDGE = os.getenv("OPENAI_HEDGE", "0") == "1"  # 超過近期 p95 仍未回應時送出相同的對沖請求
+OPENAI_HEDGE_MIN_DELAY = float(os.getenv("OPENAI_HEDGE_MIN_DELAY", 2))  # 對沖前至少等待的秒數
+OPENAI_BREAKER_THRESHOLD = int(os.getenv("OPENAI_BREAKER_THRESHOLD", 5))  # 連續幾次呼叫重試後仍失敗時開啟斷路器
+OPENAI_BREAKER_COOLDOWN = float(os.getenv("OPENAI_BREAKER_COOLDOWN", 30))  # 斷路器開啟後直接拒絕請求的秒數
+# 對話壓縮設定
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", 24000))  # 每次請求的輸入 tokens 預算（共用前綴布局下不含系統提示）
+COMPACTION_KEEP_TURNS = int(os.getenv("COMPACTION_KEEP_TURNS", 3))  # 壓縮時原文保留的最近對話輪數（至少保留 1 輪）
+COMPACTION_MODEL = os.getenv("COMPACTION_MODEL", "")  # 設定時以此模型產生摘要，否則在本地整理
+COMPACTION_MAX_NEEDS = 20  # 摘要中保留的需求條目上限
+LOCAL_FLOW_ENABLED = os.getenv("LOCAL_FLOW_ENABLED", "1") != "0"  # 招呼、分類選單、分類確認與電子郵件收集在本地回覆
+STREAM_UPDATE_INTERVAL = float(os.getenv("STREAM_UPDATE_INTERVAL", 0.05))  # 串流時聊天視窗的最短更新間隔（秒）
+# 回應快取設定
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 512))  # 快取的回應數上限，0 表示停用
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 3600))  # 快取回應的有效秒數
+RESPONSE_CACHE_MAX_TURNS = int(os.getenv("RESPONSE_CACHE_MAX_TURNS", 2))  # 只快取用戶消息數不超過此值的對話開頭
+RESPONSE_CACHE_MAX_CHARS = int(os.getenv("RESPONSE_CACHE_MAX_CHARS", 4000))  # 超過此長度的回應不快取
+# 請求大小設定
+MODEL_CONTEXT_LIMIT = int(os.getenv("MODEL_CONTEXT_LIMIT", 1047576))  # 模型的上下文長度上限
+MAX_COMPLETION_TOKENS = int(os.getenv("MAX_COMPLETION_TOKENS", 4096))  # 每次回覆的 tokens 上限
+MIN_COMPLETION_TOKENS = 256  # 預留給回覆的最少 tokens
+MESSAGE_OVERHEAD_TOKENS = 3  # 每條消息在聊天格式中的額外 tokens
+REPLY_PRIMING_TOKENS = 3  # 回覆起始的額外 tokens
+
+# Prometheus 文字格式的監控指標，由 /metrics 輸出
+METRICS = []
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+def format_metric_labels(names, values):
+    if not names:
+        return ""
+    escaped = [str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+class Metric:
+    """指標基底類別，建立時自動註冊到 METRICS"""
+
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self):
+        return []
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"] + self.samples()
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def total(self):
+        with self._lock:
+            return sum(self._values.values())
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{format_metric_labels(self.labelnames, key)} {value}" for key, value in items]
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, totals = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0, 0]))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            totals[0] += value
+            totals[1] += 1
+
+    def samples(self):
+        lines = []
+        with self._lock:
+            items = sorted((key, (list(counts), list(totals))) for key, (counts, totals) in self._values.items())
+        for key, (counts, (total, count)) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                labels = format_metric_labels(self.labelnames + ("le",), key + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_metric_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class CallbackMetric(Metric):
+    """輸出時才呼叫函數取值，用於會話數、佇列深度等既有狀態"""
+
+    def __init__(self, name, help_text, func, kind="gauge"):
+        super().__init__(name, help_text)
+        self.func = func
+        self.kind = kind
+
+    def samples(self):
+        try:
+            return [f"{self.name} {self.func()}"]
+        except Exception as e:
+            logging.error(f"讀取指標 {self.name} 時發生錯誤: {str(e)}")
+            return []
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+TURN_LATENCY = Histogram("chat_turn_duration_seconds", "End-to-end latency of a chat turn", ("source",))
+TURNS_COALESCED = Counter("chat_turns_coalesced_total", "Duplicate submissions attached to an in-flight turn")
+TURNS_QUEUED = Counter("chat_turns_queued_total", "Turns that waited for an earlier turn of the same session")
+OPENAI_LATENCY = Histogram("openai_request_duration_seconds", "Latency of OpenAI API calls", ("model",))
+OPENAI_ERRORS = Counter("openai_request_errors_total", "Failed OpenAI API calls", ("model",))
+OPENAI_RETRIES = Counter("openai_retries_total", "OpenAI API calls retried after a timeout, 429 or 5xx", ("model",))
+OPENAI_HEDGES = Counter("openai_hedged_requests_total", "Hedged duplicate OpenAI requests", ("model",))
+PROMPT_TOKENS = Counter("openai_prompt_tokens_total", "Prompt tokens billed", ("step", "model"))
+CACHED_PROMPT_TOKENS = Counter("openai_cached_prompt_tokens_total", "Prompt tokens served from the provider prompt cache", ("step", "model"))
+COMPLETION_TOKENS = Counter("openai_completion_tokens_total", "Completion tokens billed", ("step", "model"))
+PRODUCT_RECOMMENDATIONS = Counter("product_recommendations_total", "Products mentioned in model replies", ("category",))
+API_COST = Counter("openai_cost_usd_total", "Estimated OpenAI API cost in USD", ("model",))
+CallbackMetric("active_sessions", "Sessions held in memory", lambda: len(session_store))
+CallbackMetric("openai_requests_in_flight", "OpenAI API calls in progress",
+               lambda: sum(d.in_flight for d in list(_dispatchers.values())))
+CallbackMetric("openai_requests_waiting", "OpenAI API calls waiting for a concurrency slot or rate limit",
+               lambda: sum(d.waiting for d in list(_dispatchers.values())))
+CallbackMetric("openai_circuit_open", "Whether the OpenAI circuit breaker is rejecting requests",
+               lambda: max([int(d.breaker.is_open()) for d in list(_dispatchers.values())] or [0]))
+CallbackMetric("email_outbox_depth", "Emails waiting to be sent", lambda: len(email_outbox))
+CallbackMetric("chat_turns_in_flight", "Chat turns being processed or queued", lambda: len(single_flight))
+CallbackMetric("response_cache_entries", "Entries in the response cache", lambda: len(response_cache))
+CallbackMetric("response_cache_hits_total", "Response cache hits", lambda: response_cache.hits, kind="counter")
+CallbackMetric("response_cache_misses_total", "Response cache misses", lambda: response_cache.misses, kind="counter")
+
+
+def make_message(role, content):
+    """建立對話消息，並在加入時計算一次其 tokens（含聊天格式的額外 tokens）"""
+    return {"role": role, "content": content, "tokens": count_tokens(content) + MESSAGE_OVERHEAD_TOKENS}
+
+def set_messages(session, start, end, messages):
+    """以 messages 取代 conversation[start:end]，同時更新會話的 tokens 累計"""
+    conversation = session["conversation"]
+    removed = sum(m["tokens"] for m in conversation[start:end])
+    conversation[start:end] = messages
+    session["conversation_tokens"] += sum(m["tokens"] for m in messages) - removed
+
+def append_message(session, role, content):
+    """在對話末尾加入消息"""
+    end = len(session["conversation"])
+    set_messages(session, end, end, [make_message(role, content)])
+
+def get_focus_tokens(session):
+    focus = session.get("focus")
+    return focus["tokens"] if focus else 0
+
+def get_prompt_tokens(session):
+    """依 tokens 帳本計算目前對話作為請求時的輸入 tokens（含聚焦消息）"""
+    return session["conversation_tokens"] + get_focus_tokens(session) + REPLY_PRIMING_TOKENS
+
+def to_api_messages(conversation):
+    """去除帳本欄位，轉換為 API 需要的消息格式"""
+    return [{"role": m["role"], "content": m["content"]} for m in conversation]
+
+def build_request_messages(session):
+    """請求的消息列表：聚焦消息放在最新一條消息之前，讓共用前綴與較早的對話在各輪之間保持不變"""
+    messages = to_api_messages(session["conversation"])
+    focus = session.get("focus")
+    if focus:
+        messages.insert(len(messages) - 1, {"role": "system", "content": focus["content"]})
+    return messages
+
+def count_leading_system_messages(conversation):
+    """計算對話開頭的系統消息數（系統提示及對話摘要）"""
+    count = 0
+    while count < len(conversation) and conversation[count]["role"] == "system":
+        count += 1
+    return count
+
+
+def new_flow_state():
+    """推薦流程的初始狀態（介面以 gr.State 保存，API 會話保存在 session["state"]）"""
+    return {
+        "step": 0,
+        "top_matches": None,
+        "products_info": None,
+        "recommendations": "",
+        "email_content": "",
+        "chat_history": [],
+        "current_category": None,
+        "awaiting_category": False,
+        "recommended_products": [],
+        "email": ""
+    }
+
+def reset_flow_state(state):
+    """開始新的諮詢時重置流程步驟與分類，避免新需求被鎖定在上一次的分類（保留電子郵件等客戶資料）"""
+    state["step"] = 0
+    state["current_category"] = None
+    state["awaiting_category"] = False
+    state["recommended_products"] = []
+
+class SQLiteSessionBackend:
+    """以 SQLite (WAL) 保存會話，讓重啟後的進程能繼續進行中的對話
+
+    消息只新增不修改，刪減或摘要對話時只更新會話記錄中的消息序號列表；
+    寫入由背景執行緒批次完成，不在請求路徑上等待磁碟。
+    """
+
+    SESSION_FIELDS = ("conversation_tokens", "system_prompt_loaded", "uses_retrieval", "summary_needs",
+                      "focus", "api_cost", "state", "next_seq", "revision")
+
+    def __init__(self, path, idle_ttl, flush_interval=0.2):
+        self.path = path
+        self.idle_ttl = idle_ttl
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._pending = {}  # 會話 ID -> 最後一筆尚未寫入記錄的完成事件
+        self._pending_lock = threading.Lock()
+        self._local = threading.local()
+        self._thread = None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    message_seqs TEXT NOT NULL,
+                    catalog_version TEXT,
+                    revision INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS messages (
+                    session_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    tokens INTEGER NOT NULL,
+                    PRIMARY KEY (session_id, seq)
+                );
+                CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at);
+            """)
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(sessions)")]
+            if "revision" not in columns:
+                conn.execute("ALTER TABLE sessions ADD COLUMN revision INTEGER NOT NULL DEFAULT 0")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _reader(self):
+        # 讀取在呼叫端執行緒進行，每個執行緒使用自己的連線
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="session-writer", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def save(self, session_id, session):
+        """記錄會話目前的內容：新消息配發序號後排入寫入佇列，立即返回寫入完成時設定的事件"""
+        self.start()
+        session["revision"] += 1
+        rows = []
+        new_rows = 0
+        for message in session["conversation"]:
+            if "seq" not in message:
+                message["seq"] = session["next_seq"]
+                session["next_seq"] += 1
+                new_rows += 1
+            rows.append((session_id, message["seq"], message["role"], message["content"], message["tokens"]))
+        # 新消息的序號一定最大，排在最後
+        rows.sort(key=lambda row: row[1])
+        data = json.dumps({field: session[field] for field in self.SESSION_FIELDS}, ensure_ascii=False)
+        seqs = json.dumps([message["seq"] for message in session["conversation"]])
+        return self._enqueue(session_id, ("save", session_id, rows, new_rows, data, seqs, session["catalog"]["version"],
+                                          session["revision"], time.time()))
+
+    def delete(self, session_id):
+        self.start()
+        return self._enqueue(session_id, ("delete", session_id))
+
+    def _enqueue(self, session_id, item):
+        done = threading.Event()
+        with self._pending_lock:
+            self._pending[session_id] = done
+        self._queue.put(item + (done,))
+        return done
+
+    def flush(self):
+        """等待佇列中的記錄全部寫入"""
+        if self._thread is not None:
+            self._queue.join()
+
+    def load(self, session_id):
+        """讀取會話內容，不存在或已閒置逾時時回傳 None"""
+        self._wait_pending(session_id)
+        conn = self._reader()
+        row = conn.execute(
+            "SELECT data, message_seqs, catalog_version, updated_at FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None or time.time() - row[3] > self.idle_ttl:
+            return None
+        data, seqs, catalog_version = json.loads(row[0]), json.loads(row[1]), row[2]
+        messages = {
+            seq: {"role": role, "content": content, "tokens": tokens, "seq": seq}
+            for seq, role, content, tokens in conn.execute(
+                "SELECT seq, role, content, tokens FROM messages WHERE session_id = ?", (session_id,)
+            )
+        }
+        data["conversation"] = [messages[seq] for seq in seqs if seq in messages]
+        data["catalog_version"] = catalog_version
+        return data
+
+    def _wait_pending(self, session_id):
+        # 此進程尚未寫入的記錄先完成，避免讀到舊內容
+        with self._pending_lock:
+            pending = self._pending.get(session_id)
+        if pending is not None:
+            pending.wait(timeout=10)
+
+    def exists(self, session_id):
+        return self.load(session_id) is not None
+
+    def revision(self, session_id):
+        """資料庫中會話的版本號，不存在時回傳 None；供多個 worker 判斷記憶體中的會話是否過期"""
+        self._wait_pending(session_id)
+        row = self._reader().execute("SELECT revision FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return row[0] if row else None
+
+    def _run(self):
+        conn = self._connect()
+        last_cleanup = time.monotonic()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            # 合併短時間內的多筆記錄，以一個交易寫入
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                batch.append(item)
+                if item is None:
+                    break
+            stop = batch[-1] is None
+            records = [item for item in batch if item is not None]
+            try:
+                self._write(conn, records)
+                if time.monotonic() - last_cleanup > 60:
+                    self._cleanup(conn)
+                    last_cleanup = time.monotonic()
+            except Exception as e:
+                logging.error(f"寫入會話資料庫時發生錯誤: {str(e)}")
+            finally:
+                with self._pending_lock:
+                    for record in records:
+                        session_id, done = record[1], record[-1]
+                        if self._pending.get(session_id) is done:
+                            del self._pending[session_id]
+                        done.set()
+                for _ in batch:
+                    self._queue.task_done()
+            if stop:
+                break
+        conn.close()
+
+    def _write(self, conn, records):
+        # 依佇列順序套用，同一批中先刪除再重新建立的會話不會留下舊消息
+        with conn:
+            for record in records:
+                if record[0] == "delete":
+                    conn.execute("DELETE FROM sessions WHERE session_id = ?", (record[1],))
+                    conn.execute("DELETE FROM messages WHERE session_id = ?", (record[1],))
+                    continue
+                _, session_id, rows, new_rows, data, seqs, catalog_version, revision, updated_at, _ = record
+                # 會話已被刪除或閒置清除而記憶體中仍在使用時，重新寫入全部消息，避免序號列表指向不存在的消息
+                if conn.execute("SELECT 1 FROM sessions WHERE session_id = ?", (session_id,)).fetchone():
+                    rows = rows[len(rows) - new_rows:]
+                conn.executemany(
+                    "INSERT OR IGNORE INTO messages (session_id, seq, role, content, tokens) VALUES (?, ?, ?, ?, ?)", rows
+                )
+                conn.execute(
+                    "INSERT OR REPLACE INTO sessions (session_id, data, message_seqs, catalog_version, revision, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", (session_id, data, seqs, catalog_version, revision, updated_at)
+                )
+
+    def _cleanup(self, conn):
+        """刪除閒置逾時的會話及其消息"""
+        cutoff = time.time() - self.idle_ttl
+        with conn:
+            conn.execute("DELETE FROM messages WHERE session_id IN (SELECT session_id FROM sessions WHERE updated_at < ?)", (cutoff,))
+            deleted = conn.execute("DELETE FROM sessions WHERE updated_at < ?", (cutoff,)).rowcount
+        if deleted:
+            logging.info(f"已從會話資料庫刪除 {deleted} 個閒置會話")
+
+    def close(self):
+        """停止背景執行緒前寫入剩餘的記錄"""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=10)
+
+
+class SessionStore:
+    """以會話 ID 為鍵的對話存儲，限制每個會話的消息數、閒置時間與總會話數
+
+    設定 backend 時，會話在每輪結束後寫入，不在記憶體中的會話於首次存取時載入。
+    shared 表示多個 worker 共用 backend：每輪結束等待寫入完成，存取時若資料庫中的版本較新則重新載入。
+    事件循環中以 fetch / contains 在執行緒中查詢資料庫，同一輪稍後以 get(refresh=False) 取用記憶體中的會話。
+    """
+
+    def __init__(self, max_messages, idle_ttl, max_sessions, backend=None, shared=False):
+        self.max_messages = max_messages
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.backend = backend
+        self.shared = shared and backend is not None
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @staticmethod
+    def _new_session():
+        return {
+            "conversation": [],
+            "conversation_tokens": 0,
+            "system_prompt_loaded": False,
+            "uses_retrieval": False,
+            "summary_needs": [],
+            "focus": None,
+            "catalog": catalog,
+            "api_cost": 0.0,
+            "state": new_flow_state(),
+            "next_seq": 0,
+            "revision": 0,
+            "last_access": time.monotonic()
+        }
+
+    @classmethod
+    def _restore_session(cls, data):
+        session = cls._new_session()
+        catalog_version = data.pop("catalog_version")
+        session.update(data)
+        if catalog_version != catalog["version"]:
+            # 原目錄已不在記憶體中，已載入的系統提示保留原內容，新的檢索使用目前目錄
+            logging.warning(f"會話的產品目錄版本 {str(catalog_version)[:12]} 已更新，改用目前版本")
+        return session
+
+    def __contains__(self, session_id):
+        with self._lock:
+            if session_id in self._sessions:
+                return True
+        return self.backend is not None and self.backend.exists(session_id)
+
+    async def contains(self, session_id):
+        if self.backend is None:
+            return session_id in self
+        return await asyncio.to_thread(self.__contains__, session_id)
+
+    def get(self, session_id, refresh=True):
+        """取得會話（不存在時建立），並更新最近使用時間；已閒置逾時的會話視為不存在
+
+        refresh 為 False 時不向資料庫確認版本，只在會話不在記憶體中時載入。
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None and time.monotonic() - session["last_access"] > self.idle_ttl:
+                self._expire(session_id)
+                session = None
+        loaded = None
+        if self.backend is not None:
+            # 其他 worker 處理過此會話時，記憶體中的內容已過期
+            stale = session is not None and self.shared and refresh \
+                and (self.backend.revision(session_id) or 0) > session["revision"]
+            if session is None or stale:
+                loaded = self.backend.load(session_id)
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if loaded is not None and (session is None or loaded["revision"] > session["revision"]):
+                session = self._restore_session(loaded)
+                self._sessions[session_id] = session
+                logging.info(f"從會話資料庫載入會話: {session_id}")
+            elif session is None:
+                session = self._new_session()
+                self._sessions[session_id] = session
+            self._sessions.move_to_end(session_id)
+            session["last_access"] = now
+            self._evict(now)
+        return session
+
+    async def fetch(self, session_id):
+        """在執行緒中執行 get，載入與版本查詢不阻塞事件循環"""
+        if self.backend is None:
+            return self.get(session_id)
+        return await asyncio.to_thread(self.get, session_id)
+
+    def save(self, session_id):
+        """將會話排入背景寫入（未設定 backend 時不做任何事）"""
+        if self.backend is None:
+            return
+        with self._lock:
+            session = self._sessions.get(session_id)
+        if session is None:
+            return
+        try:
+            return self.backend.save(session_id, session)
+        except Exception as e:
+            logging.error(f"保存會話時發生錯誤: {str(e)}")
+
+    async def commit(self, session_id):
+        """每輪結束時保存會話；多個 worker 共用時等待寫入完成，下一輪由其他 worker 處理也能讀到"""
+        done = self.save(session_id)
+        if done is not None and self.shared:
+            await asyncio.to_thread(done.wait, 10)
+
+    def reset(self, session_id):
+        """清空會話的對話歷史，保留累計成本；呼叫前應已以 get 或 fetch 取得最新的會話"""
+        session = self.get(session_id, refresh=False)
+        session["conversation"] = []
+        session["conversation_tokens"] = 0
+        session["system_prompt_loaded"] = False
+        session["uses_retrieval"] = False
+        session["summary_needs"] = []
+        session["focus"] = None
+        # 重置時才切換到最新的產品目錄，進行中的對話維持一致的目錄
+        session["catalog"] = catalog
+        self.save(session_id)
+        return session
+
+    def trim(self, session):
+        """限制對話歷史長度，保留系統提示（及摘要）並從最早的消息開始刪除"""
+        conversation = session["conversation"]
+        start = count_leading_system_messages(conversation)
+        excess = len(conversation) - start - self.max_messages
+        if excess <= 0:
+            return
+        end = start + excess
+        # 確保保留的歷史以用戶消息開始
+        while end < len(conversation) and conversation[end]["role"] != "user":
+            end += 1
+        set_messages(session, start, end, [])
+        logging.info(f"對話歷史超過上限，已刪除最早的 {excess} 條以上消息")
+
+    def _expire(self, session_id):
+        self._sessions.pop(session_id, None)
+        # 共用時其他 worker 可能仍在處理此會話，資料庫中的過期由 backend 依 updated_at 清除
+        if self.backend is not None and not self.shared:
+            self.backend.delete(session_id)
+        logging.info(f"清除閒置會話: {session_id}")
+
+    def _evict(self, now):
+        # 由最久未使用的會話開始清除閒置會話
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if now - session["last_access"] <= self.idle_ttl:
+                break
+            self._expire(session_id)
+        # 超過會話數上限時，依 LRU 清除（有 backend 時之後仍可從資料庫載入）
+        while len(self._sessions) > self.max_sessions:
+            session_id, _ = self._sessions.popitem(last=False)
+            logging.info(f"會話數超過上限，清除最久未使用的會話: {session_id}")
+
+
+session_store = SessionStore(
+    SESSION_MAX_MESSAGES, SESSION_IDLE_TTL, SESSION_MAX_COUNT,
+    SQLiteSessionBackend(SESSION_DB_PATH, SESSION_IDLE_TTL, SESSION_DB_FLUSH_INTERVAL) if SESSION_DB_PATH else None,
+    shared=SESSION_SHARED
+)
+
+
+class ResponseCache:
+    """以產品目錄版本、模型與正規化後的對話為鍵的 LRU + TTL 回應快取"""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def normalize(text):
+        """忽略大小寫、多餘空白及結尾標點，讓「你好！」與「你好」視為相同"""
+        text = re.sub(r'\s+', ' ', text.strip().lower())
+        return text.rstrip('!！?？.。~～,，、 ')
+
+    @classmethod
+    def make_key(cls, version, model, messages):
+        normalized = [
+            (m["role"], m["content"] if m["role"] == "system" else cls.normalize(m["content"]))
+            for m in messages
+        ]
+        payload = json.dumps([version, model, normalized], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or now - entry[1] > self.ttl:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, reply):
+        with self._lock:
+            self._entries[key] = (reply, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+def is_cacheable_conversation(messages):
+    """只有對話開頭（用戶消息數不多）才使用回應快取"""
+    if RESPONSE_CACHE_SIZE <= 0:
+        return False
+    return sum(1 for m in messages if m["role"] == "user") <= RESPONSE_CACHE_MAX_TURNS
 
 # 定義系統提示
 base_system_prompt = """# 角色與目標
@@ -104,9 +900,16 @@ base_system_prompt = """# 角色與目標
   - 根據新資訊調整推薦。
 """
 
-def load_excel_data():
+def compute_file_hash(file_path):
+    """計算檔案的 SHA-256 雜湊值，作為產品目錄版本"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_excel_data(file_path=CATALOG_FILE):
     try:
-        file_path = 'GPTdata0325.xlsx'
         if not os.path.exists(file_path):
             logging.error(f"找不到檔案: {file_path}")
             raise FileNotFoundError(f"找不到檔案: {file_path}")
@@ -129,235 +932,566 @@ def load_excel_data():
         logging.error(f"載入Excel數據時發生錯誤: {str(e)}")
         raise
 
-# 載入產品數據
-try:
-    df = load_excel_data()
-    # 建立產品分類緩存
-    for _, row in df.iterrows():
-        category = row['產品第一層分類']
-        if category not in product_categories:
-            product_categories[category] = []
-        product_categories[category].append(row.to_dict())
-except Exception as e:
-    logging.error(f"初始化數據時發生錯誤: {str(e)}")
-    raise
+token_count_failures = 0  # count_tokens 失敗（回傳 0）的次數；建立產品目錄時期間有失敗則不寫入快照
 
 def count_tokens(text):
     """使用 tiktoken 計算文本的 token 數量"""
+    global token_count_failures
     try:
         # 使用 o3-mini-2025-01-31 模型對應的編碼器
         encoding = tiktoken.get_encoding("cl100k_base")
         tokens = len(encoding.encode(text))
         return tokens
     except Exception as e:
+        token_count_failures += 1
         logging.error(f"計算 tokens 時發生錯誤: {str(e)}")
         return 0
 
-def calculate_system_tokens():
-    """計算系統提示的 tokens"""
-    try:
-        base_system_prompt = """# 角色與目標
-你是智慧照顧產品推薦專家。你的任務是根據客戶的需求，從下方提供的產品資料中，為客戶推薦合適的智慧照顧產品。
+# 產品紀錄保留的 Excel 欄位及對應屬性名稱（公司地址等未使用的欄位不保留）
+PRODUCT_FIELDS = {
+    '產品名稱': 'name',
+    '公司名稱': 'company',
+    '連絡電話': 'phone',
+    '產品網址': 'url',
+    '主要功能': 'function',
+    '使用方式': 'usage',
+    '產品第一層分類': 'category',
+    '產品第二層分類': 'subcategory'
+}
+INTERNED_FIELDS = ('公司名稱', '產品第一層分類', '產品第二層分類')  # 大量重複、共用同一字串實例的欄位
+
+
+class Product:
+    """精簡的產品紀錄，以 __slots__ 存儲並保留 dict 風格的 get() 介面"""
+
+    __slots__ = ('id',) + tuple(PRODUCT_FIELDS.values())
+
+    def __init__(self, product_id, *values):
+        self.id = product_id
+        for attr, value in zip(PRODUCT_FIELDS.values(), values):
+            setattr(self, attr, value)
+
+    def get(self, column, default=None):
+        """以 Excel 欄位名稱取值，空白欄位回傳 default"""
+        attr = PRODUCT_FIELDS.get(column)
+        value = getattr(self, attr) if attr else None
+        return default if value is None else value
+
+    def __getitem__(self, column):
+        if column not in PRODUCT_FIELDS:
+            raise KeyError(column)
+        return getattr(self, PRODUCT_FIELDS[column])
+
+    def to_row(self):
+        return tuple(getattr(self, attr) for attr in self.__slots__)
+
+    def __repr__(self):
+        return f"Product(id={self.id}, name={self.name!r})"
+
+
+def format_product_info(product):
+    """將單一產品轉換為提示詞中的產品資訊格式"""
+    return (
+        f"產品名稱：{product.get('產品名稱', 'N/A')}\n"
+        f"公司名稱：{product.get('公司名稱', 'N/A')}\n"
+        f"主要功能：{product.get('主要功能', 'N/A')}\n"
+        f"使用方式：{product.get('使用方式', 'N/A')}\n"
+        f"產品網址：{product.get('產品網址', 'N/A')}\n"
+        f"連絡電話：{product.get('連絡電話', 'N/A')}\n"
+        f"分類：{product.get('產品第一層分類', 'N/A')} > {product.get('產品第二層分類', 'N/A')}\n"
+        f"---"
+    )
 
-# 重要限制
-- 絕對禁止提及或暗示你參考的資料來源。
-- 所有推薦必須自然呈現，如同基於你的專業知識。
-- 請嚴格依照以下推薦流程步驟進行。
-- 任何對話都必須使用繁體中文亦或是使用者使用的語言。
+def assemble_system_prompt(product_texts, categories_info):
+    """以已格式化的產品資訊組合完整的系統提示"""
+    products_block = "==== 產品資訊 ====\n" + "\n".join(product_texts) + "\n==== 產品資訊結束 ===="
+    return base_system_prompt + "\n\n" + categories_info + "\n\n" + products_block, products_block
+
+def render_prompt_bundle(product_texts, categories_info):
+    """渲染一組產品的完整系統提示，並計算其 tokens"""
+    system_prompt, products_block = assemble_system_prompt(product_texts, categories_info)
+    return {
+        "system_prompt": system_prompt,
+        "product_count": len(product_texts),
+        "products_tokens": count_tokens(products_block),
+        "tokens": count_tokens(system_prompt)
+    }
 
-# 推薦流程步驟
+def build_prompt_bundles(categories, version):
+    """預先渲染完整目錄及各第一層分類的系統提示"""
+    categories_info = "可用分類：\n" + "\n".join([f"- {cat}" for cat in categories.keys()])
+    # 依產品在目錄中的順序保存格式化結果，供檢索結果直接組合
+    product_texts = [format_product_info(product) for products in categories.values() for product in products]
+    category_texts = {}
+    offset = 0
+    for category, products in categories.items():
+        category_texts[category] = product_texts[offset:offset + len(products)]
+        offset += len(products)
+    bundles = {
+        "version": version,
+        "categories_info": categories_info,
+        "product_texts": product_texts,
+        "all": render_prompt_bundle(product_texts, categories_info),
+        "categories": {
+            category: render_prompt_bundle(texts, categories_info)
+            for category, texts in category_texts.items()
+        }
+    }
+    logging.info(f"提示詞組合建立完成 - 版本: {str(version)[:12]}, 分類數: {len(bundles['categories'])}, "
+                 f"完整目錄 tokens: {bundles['all']['tokens']}")
+    return bundles
+
+def get_prompt_bundle(category=None, active_catalog=None):
+    """取得預先渲染的系統提示（預設使用目前的產品目錄）"""
+    bundles = (active_catalog or catalog)["prompt_bundles"]
+    if category and category in bundles["categories"]:
+        return bundles["categories"][category]
+    return bundles["all"]
+
+def tokenize_ngrams(text):
+    """將文本切分為檢索用的詞元：中文取字元二元組，英數字取完整單字"""
+    terms = []
+    for segment in re.findall(r'[a-z0-9]+|[^\sa-z0-9]+', str(text).lower()):
+        if segment.isascii():
+            terms.append(segment)
+            continue
+        chars = [c for c in segment if c.isalnum()]
+        if len(chars) == 1:
+            terms.append(chars[0])
+        terms.extend(chars[i] + chars[i + 1] for i in range(len(chars) - 1))
+    return terms
+
+class ProductIndex:
+    """以 BM25 對產品建立的詞法檢索索引，倒排表以 NumPy 陣列 (CSR) 存儲"""
+
+    STATE_FIELDS = ('categories', 'vocabulary', 'postings', 'indptr', 'weights')
+
+    def __init__(self, products, k1=1.5, b=0.75):
+        self.products = products
+        self.categories = np.array([str(p.get('產品第一層分類', '')) for p in products], dtype=object)
+        vocabulary = {}
+        term_ids, doc_ids, freqs = [], [], []
+        doc_lengths = np.zeros(len(products), dtype=np.float64)
+        for doc_id, product in enumerate(products):
+            text = " ".join(str(product.get(col, '')) for col in RETRIEVAL_COLUMNS)
+            terms = tokenize_ngrams(text)
+            doc_lengths[doc_id] = len(terms)
+            counts = {}
+            for term in terms:
+                term_id = vocabulary.setdefault(term, len(vocabulary))
+                counts[term_id] = counts.get(term_id, 0) + 1
+            term_ids.extend(counts.keys())
+            doc_ids.extend([doc_id] * len(counts))
+            freqs.extend(counts.values())
+
+        self.vocabulary = vocabulary
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        order = np.argsort(term_ids, kind='stable')
+        self.postings = np.asarray(doc_ids, dtype=np.int32)[order]
+        tf = np.asarray(freqs, dtype=np.float64)[order]
+        doc_freq = np.bincount(term_ids, minlength=len(vocabulary))
+        self.indptr = np.concatenate(([0], np.cumsum(doc_freq)))
+
+        # 預先計算每個倒排項目的 BM25 權重
+        doc_count = len(products)
+        idf = np.log(1 + (doc_count - doc_freq + 0.5) / (doc_freq + 0.5))
+        avg_length = max(doc_lengths.mean(), 1.0) if doc_count else 1.0
+        norm = k1 * (1 - b + b * doc_lengths[self.postings] / avg_length)
+        self.weights = np.repeat(idf, doc_freq) * tf * (k1 + 1) / (tf + norm)
+
+    def search(self, query, top_k, category=None, min_score=0.0):
+        """回傳與查詢最相關的產品編號（依分數由高至低），最佳分數未達 min_score 時回傳空列表"""
+        scores = np.zeros(len(self.products), dtype=np.float64)
+        for term in set(tokenize_ngrams(query)):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            np.add.at(scores, self.postings[start:end], self.weights[start:end])
+        if category:
+            scores[self.categories != category] = 0.0
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) == 0 or scores.max() < min_score:
+            return []
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        return candidates[np.argsort(-scores[candidates], kind='stable')].tolist()
+
+    def get_state(self):
+        """索引的純資料內容（供快照存儲）"""
+        return {field: getattr(self, field) for field in self.STATE_FIELDS}
+
+    @classmethod
+    def from_state(cls, products, state):
+        """由快照內容還原索引，不需重新分詞"""
+        index = cls.__new__(cls)
+        index.products = products
+        for field in cls.STATE_FIELDS:
+            setattr(index, field, state[field])
+        return index
+
+def build_product_index(categories):
+    """在載入產品目錄時建立檢索索引"""
+    products = [product for products in categories.values() for product in products]
+    index = ProductIndex(products)
+    logging.info(f"產品檢索索引建立完成 - 產品數: {len(products)}, 詞元數: {len(index.vocabulary)}")
+    return index
+
+class CatalogMatcher:
+    """以 Aho-Corasick 自動機一次掃描回覆，找出提到的所有分類及產品名稱，耗時只與回覆長度有關"""
+
+    STATE_FIELDS = ('goto', 'fail', 'outputs', 'output_link', 'patterns')
+
+    def __init__(self, products):
+        # 模式: (種類, 值, 長度)；種類為 category / subcategory / product，產品的值為產品編號
+        self.patterns = []
+        self.goto = [{}]
+        self.outputs = [()]
+        seen = set()
+        for product in products:
+            for kind, text, value in (("category", product.category, product.category),
+                                      ("subcategory", product.subcategory, product.subcategory),
+                                      ("product", product.name, product.id)):
+                if text is None or (kind, value) in seen:
+                    continue
+                seen.add((kind, value))
+                text = str(text).strip()
+                if text:
+                    self._add(text, (kind, value, len(text)))
+
+        # 以廣度優先建立失敗連結，output_link 指向失敗鏈上下一個有輸出的節點
+        self.fail = [0] * len(self.goto)
+        self.output_link = [-1] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(char, 0)
+                self.fail[child] = target if target != child else 0
+                parent = self.fail[child]
+                self.output_link[child] = parent if self.outputs[parent] else self.output_link[parent]
+
+    def _add(self, text, pattern):
+        node = 0
+        for char in text:
+            child = self.goto[node].get(char)
+            if child is None:
+                child = len(self.goto)
+                self.goto[node][char] = child
+                self.goto.append({})
+                self.outputs.append(())
+            node = child
+        self.outputs[node] += (len(self.patterns),)
+        self.patterns.append(pattern)
+
+    def find_all(self, text):
+        """回傳 [(結束位置, 種類, 值, 長度)]，依出現位置排序"""
+        matches = []
+        goto, fail, outputs, output_link, patterns = self.goto, self.fail, self.outputs, self.output_link, self.patterns
+        node = 0
+        for position, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            hit = node if outputs[node] else output_link[node]
+            while hit > 0:
+                matches.extend((position + 1,) + patterns[i] for i in outputs[hit])
+                hit = output_link[hit]
+        return matches
+
+    def scan(self, text):
+        """依出現順序回傳提到的第一層分類、第二層分類與產品編號（各自去重）
+
+        產品名稱被另一個較長的產品名稱包含時，只計入較長的那一個。
+        """
+        matches = sorted(self.find_all(text), key=lambda m: (m[0] - m[3], -m[3]))
+        spans = [(end - length, end) for end, kind, _, length in matches if kind == "product"]
+        found = {"category": [], "subcategory": [], "product": []}
+        for end, kind, value, length in matches:
+            start = end - length
+            if kind == "product" and any(s <= start and end <= e and e - s > length for s, e in spans):
+                continue
+            if value not in found[kind]:
+                found[kind].append(value)
+        return found
+
+    def get_state(self):
+        """自動機的純資料內容（供快照存儲）"""
+        return {field: getattr(self, field) for field in self.STATE_FIELDS}
+
+    @classmethod
+    def from_state(cls, state):
+        matcher = cls.__new__(cls)
+        for field in cls.STATE_FIELDS:
+            setattr(matcher, field, state[field])
+        return matcher
+
+def build_catalog_matcher(products):
+    """在載入產品目錄時建立分類與產品名稱的比對自動機"""
+    matcher = CatalogMatcher(products)
+    logging.info(f"分類與產品名稱比對自動機建立完成 - 模式數: {len(matcher.patterns)}, 節點數: {len(matcher.goto)}")
+    return matcher
+
+def build_system_prompt(state, conversation, user_input, active_catalog):
+    """依客戶需求選擇系統提示：產品數超過 RETRIEVAL_TOP_K 時只注入最相關的產品
+
+    回傳 (系統提示, 產品數, 是否使用檢索)；檢索沒有匹配時退回完整的預先渲染提示。
+    """
+    category = state.get("current_category")
+    prompt_bundles = active_catalog["prompt_bundles"]
+    bundle = get_prompt_bundle(category, active_catalog)
+    if RETRIEVAL_TOP_K <= 0 or bundle["product_count"] <= RETRIEVAL_TOP_K:
+        return bundle["system_prompt"], bundle["product_count"], False
+
+    needs = "\n".join([m["content"] for m in conversation if m["role"] == "user"] + [user_input])
+    matches = active_catalog["product_index"].search(
+        needs, RETRIEVAL_TOP_K,
+        category=category if category in prompt_bundles["categories"] else None,
+        min_score=RETRIEVAL_MIN_SCORE
+    )
+    if not matches:
+        log_detail("檢索沒有足夠相關的產品，使用完整目錄")
+        return bundle["system_prompt"], bundle["product_count"], True
 
-## 步驟零：啟動與重置
-- 當客戶表達「開始新諮詢的意圖」時，視為啟動全新的推薦流程
-  - 例如：說「你好」、「我想找產品」、「請推薦」、「重新開始」等類似語句
-- 準備好從資料來源讀取信息，並等待客戶提出初步需求
-- 以友善的招呼語開始，例如：
-  「您好！我是智慧照顧產品推薦專家，請問您在尋找哪方面的協助或產品呢？」
+    product_texts = [prompt_bundles["product_texts"][i] for i in matches]
+    system_prompt, _ = assemble_system_prompt(product_texts, prompt_bundles["categories_info"])
+    return system_prompt, len(matches), True
 
-## 步驟一：確認第一層分類
-- 根據客戶的簡短需求，判斷最可能屬於哪一個「產品第一層分類」
-- 向客戶說明判斷的分類，並解釋該分類包含的產品類型
-- 詢問此方向是否符合客戶需求
-- 必須先完成此分類確認，請勿直接跳至第二層分類
-- 對話範例：
-  「聽起來您可能在尋找與『居家安全監控』相關的產品，這類產品通常用於偵測跌倒、異常離床或提供緊急呼叫功能。請問這個方向是您想要的嗎？」
+def build_cache_prefix(active_catalog):
+    """所有會話共用的系統提示前綴，回傳 (內容, tokens)
 
-## 步驟二：探索第二層分類需求
-- 在確認第一層分類後，仔細閱讀該分類下所有產品的功能和使用方式
-- 根據產品差異，提出具體問題引導客戶
-- 問題可圍繞：
-  - 功能偏好
-  - 使用場景
-  - 操作方式
-- 對話範例：
-  「為了更精確地推薦，請問您：
-  1. 比較重視『自動偵測並發出警報』（如跌倒偵測），還是『主動求助』（如緊急按鈕）的功能？
-  2. 對於安裝方式（固定式或穿戴式）您有特別偏好嗎？」
+    完整目錄不超過 RETRIEVAL_TOP_K 時直接使用完整目錄；否則只含角色指示與分類清單，產品改由聚焦消息提供。
+    """
+    bundle = get_prompt_bundle(None, active_catalog)
+    if RETRIEVAL_TOP_K <= 0 or bundle["product_count"] <= RETRIEVAL_TOP_K:
+        return bundle["system_prompt"], bundle["tokens"]
+    categories_info = active_catalog["prompt_bundles"]["categories_info"]
+    return base_system_prompt + "\n\n" + categories_info, bundle["tokens"] - bundle["products_tokens"]
 
-## 步驟三：統整與確認需求
-- 統整所有需求資訊
-- 指出對應的「產品第二層分類」
-- 向客戶複述完整需求並請求確認
-- 確認範例：
-  「好的，讓我整理一下您的需求：
-  - 第一層分類：『居家安全監控』
-  - 特別需求：『自動偵測異常狀態，如跌倒』功能
-  - 偏好：非穿戴式設備
-  請問我的理解正確嗎？」
+def build_focus_message(state, conversation, user_input, active_catalog):
+    """會話專屬的聚焦資訊（已確認的分類、與需求最相關的產品），沒有時回傳 None
 
-## 步驟四：提供產品推薦
-- 在確認需求無誤後，從下方提供的「產品資訊」中篩選最符合的產品。
-- 至少推薦三項產品。
-- **對於每項推薦的產品，請務必使用提供的完整資訊，包含：**
-  1.  **產品名稱**
-  2.  **公司名稱**
-  3.  **主要功能與特色**
-  4.  **產品網址**
-  5.  **廠商連絡電話**
+    放在共用前綴與較早的對話之後，每輪更新也不影響前面內容的提示詞快取。
+    """
+    prompt_bundles = active_catalog["prompt_bundles"]
+    category = state.get("current_category")
+    if category not in prompt_bundles["categories"]:
+        category = None
+    lines = []
+    if category:
+        lines.append(f"目前對話已確認的第一層分類：{category}，請只從此分類的產品中推薦。")
+
+    # 完整目錄已在共用前綴中時不需重複產品資訊
+    if RETRIEVAL_TOP_K > 0 and get_prompt_bundle(None, active_catalog)["product_count"] > RETRIEVAL_TOP_K:
+        index = active_catalog["product_index"]
+        needs = "\n".join([m["content"] for m in conversation if m["role"] == "user"] + [user_input])
+        matches = index.search(needs, RETRIEVAL_TOP_K, category=category, min_score=RETRIEVAL_MIN_SCORE)
+        if not matches:
+            log_detail("檢索沒有足夠相關的產品，使用完整目錄")
+            matches = np.flatnonzero(index.categories == category) if category else range(len(index.products))
+        lines.append("==== 產品資訊 ====\n" + "\n".join(prompt_bundles["product_texts"][i] for i in matches) + "\n==== 產品資訊結束 ====")
+    return "\n".join(lines) if lines else None
+
+def build_products(df):
+    """將 Excel 資料轉換為產品紀錄（以列順序作為產品編號），空白欄位存為 None"""
+    columns = []
+    for column in PRODUCT_FIELDS:
+        values = df[column].astype(object).where(df[column].notna(), None).tolist()
+        if column in INTERNED_FIELDS:
+            values = [sys.intern(str(v)) if v is not None else None for v in values]
+        columns.append(values)
+    return [Product(product_id, *values) for product_id, values in enumerate(zip(*columns))]
+
+def group_products(products):
+    """依產品第一層分類建立產品分類緩存"""
+    categories = {}
+    for product in products:
+        categories.setdefault(product.category, []).append(product)
+    return {category: tuple(items) for category, items in categories.items()}
+
+def assemble_catalog(version, products, categories, bundles, index, matcher, system_tokens, excel_tokens):
+    return {
+        "version": version,
+        "products": products,
+        "product_categories": categories,
+        "prompt_bundles": bundles,
+        "product_index": index,
+        "matcher": matcher,
+        "system_tokens": system_tokens,
+        "excel_tokens": excel_tokens
+    }
 
-## 步驟五：滿意度詢問與後續
-- 詢問：「請問以上推薦的產品是否符合您的期待？」
-- 如果滿意：
-  「如果您對這次的推薦感到滿意，請在下方提供您的電子郵件地址，我會將推薦結果整理後寄送給您。」
-- 如果不滿意：
-  - 回到步驟二重新詢問需求。
-  - 必要時回到步驟一重新確認分類。
-  - 根據新資訊調整推薦。
-"""
-        tokens = count_tokens(base_system_prompt)
-        logging.info(f"系統提示 tokens 計算完成: {tokens}")
-        return tokens
-    except Exception as e:
-        logging.error(f"計算系統提示 tokens 時發生錯誤: {str(e)}")
-        return 0
+def build_catalog(file_path, version):
+    """從 Excel 建立產品目錄及其衍生資料（分類、提示詞組合、檢索索引、tokens）"""
+    df = load_excel_data(file_path)
+    products = build_products(df)
+    categories = group_products(products)
+    bundles = build_prompt_bundles(categories, version)
+    return assemble_catalog(
+        version, products, categories, bundles, build_product_index(categories), build_catalog_matcher(products),
+        count_tokens(base_system_prompt), bundles["all"]["products_tokens"]
+    )
+
+def catalog_to_snapshot(active_catalog):
+    """將產品目錄轉換為只含基本型別與 NumPy 陣列的快照內容"""
+    return {
+        "format": CATALOG_SNAPSHOT_FORMAT,
+        "version": active_catalog["version"],
+        "rows": [product.to_row() for product in active_catalog["products"]],
+        "categories": {
+            category: [product.id for product in items]
+            for category, items in active_catalog["product_categories"].items()
+        },
+        "prompt_bundles": active_catalog["prompt_bundles"],
+        "index_state": active_catalog["product_index"].get_state(),
+        "matcher_state": active_catalog["matcher"].get_state(),
+        "system_tokens": active_catalog["system_tokens"],
+        "excel_tokens": active_catalog["excel_tokens"]
+    }
+
+def catalog_from_snapshot(snapshot):
+    """由快照內容還原產品目錄"""
+    products = [Product(*row) for row in snapshot["rows"]]
+    for product in products:
+        for column in INTERNED_FIELDS:
+            attr = PRODUCT_FIELDS[column]
+            value = getattr(product, attr)
+            if value is not None:
+                setattr(product, attr, sys.intern(value))
+    categories = {
+        category: tuple(products[product_id] for product_id in ids)
+        for category, ids in snapshot["categories"].items()
+    }
+    ordered = [product for items in categories.values() for product in items]
+    return assemble_catalog(
+        snapshot["version"], products, categories, snapshot["prompt_bundles"],
+        ProductIndex.from_state(ordered, snapshot["index_state"]),
+        CatalogMatcher.from_state(snapshot["matcher_state"]),
+        snapshot["system_tokens"], snapshot["excel_tokens"]
+    )
+
+def get_snapshot_path(version):
+    """快照檔名同時包含目錄版本與系統提示內容，任一變更都會產生新的快照"""
+    key = hashlib.sha256(f"{CATALOG_SNAPSHOT_FORMAT}:{version}:{base_system_prompt}".encode('utf-8')).hexdigest()
+    return os.path.join(CATALOG_SNAPSHOT_DIR, f"catalog-{key[:24]}.pkl")
 
-def calculate_excel_tokens():
-    """計算 Excel 資料的 tokens"""
+def save_catalog_snapshot(snapshot, path):
+    """寫入產品目錄快照（先寫暫存檔再替換，避免留下不完整的檔案），並清除舊版本快照"""
     try:
-        excel_text = ""
-        for category, products in product_categories.items():
-            for product in products:
-                product_text = (
-                    f"產品名稱：{product.get('產品名稱', 'N/A')}\n"
-                    f"公司名稱：{product.get('公司名稱', 'N/A')}\n"
-                    f"主要功能：{product.get('主要功能', 'N/A')}\n"
-                    f"使用方式：{product.get('使用方式', 'N/A')}\n"
-                    f"產品網址：{product.get('產品網址', 'N/A')}\n"
-                    f"連絡電話：{product.get('連絡電話', 'N/A')}\n"
-                    f"分類：{product.get('產品第一層分類', 'N/A')} > {product.get('產品第二層分類', 'N/A')}\n"
-                )
-                excel_text += product_text
-        
-        tokens = count_tokens(excel_text)
-        logging.info(f"Excel 資料 tokens 計算完成: {tokens}")
-        return tokens
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        for name in os.listdir(os.path.dirname(path)):
+            old_path = os.path.join(os.path.dirname(path), name)
+            if name.startswith("catalog-") and name.endswith(".pkl") and old_path != path:
+                os.remove(old_path)
+        logging.info(f"已寫入產品目錄快照: {path}")
     except Exception as e:
-        logging.error(f"計算 Excel 資料 tokens 時發生錯誤: {str(e)}")
-        return 0
+        # 快照只用於加速啟動，寫入失敗不影響服務
+        logging.warning(f"寫入產品目錄快照時發生錯誤: {str(e)}")
+
+def load_catalog(file_path=CATALOG_FILE, version=None):
+    """載入產品目錄：優先讀取與目前 Excel 版本相符的快照，否則解析 Excel 並寫入快照"""
+    version = version or compute_file_hash(file_path)
+    path = get_snapshot_path(version)
+    if os.path.exists(path):
+        try:
+            with open(path, 'rb') as f:
+                snapshot = pickle.load(f)
+            if snapshot.get("format") != CATALOG_SNAPSHOT_FORMAT or snapshot.get("version") != version:
+                logging.warning(f"產品目錄快照版本不符，重新建立: {path}")
+            elif not snapshot.get("system_tokens"):
+                # 舊版在 tokens 計算失敗時仍會寫入快照，tokens 為 0 的快照不可信
+                logging.warning(f"產品目錄快照的 tokens 數為 0，重新建立: {path}")
+            else:
+                logging.info(f"從快照載入產品目錄: {path}")
+                return catalog_from_snapshot(snapshot)
+        except Exception as e:
+            logging.warning(f"讀取產品目錄快照時發生錯誤，重新建立: {str(e)}")
+    failures = token_count_failures
+    new_catalog = build_catalog(file_path, version)
+    if token_count_failures != failures:
+        # tokens 計算失敗時記錄的 0 會低估系統提示，不寫入快照，下次啟動重新計算
+        logging.warning("建立產品目錄時 tokens 計算失敗，不寫入快照")
+    else:
+        save_catalog_snapshot(catalog_to_snapshot(new_catalog), path)
+    return new_catalog
+
+def apply_catalog(new_catalog):
+    """切換目前使用的產品目錄；新會話及重置後的會話才會使用新目錄"""
+    global catalog, catalog_version, product_categories, prompt_bundles, product_index, system_tokens, excel_tokens
+    catalog = new_catalog
+    catalog_version = new_catalog["version"]
+    # 快取的回應依賴舊目錄內容，重新載入後全部失效
+    response_cache.clear()
+    product_categories = new_catalog["product_categories"]
+    prompt_bundles = new_catalog["prompt_bundles"]
+    product_index = new_catalog["product_index"]
+    system_tokens = new_catalog["system_tokens"]
+    excel_tokens = new_catalog["excel_tokens"]
+    logging.info(f"產品目錄版本: {catalog_version[:12]}")
 
-# 計算初始 tokens
-system_tokens = calculate_system_tokens()
-excel_tokens = calculate_excel_tokens()
+# 載入產品數據
+try:
+    apply_catalog(load_catalog(CATALOG_FILE))
+except Exception as e:
+    logging.error(f"初始化數據時發生錯誤: {str(e)}")
+    raise
 logging.info(f"初始化完成 - 系統提示 tokens: {system_tokens}, Excel 資料 tokens: {excel_tokens}")
 
+def reload_catalog_if_changed(file_path=CATALOG_FILE):
+    """檔案雜湊與目前版本不同時重新載入產品目錄，驗證失敗則保留原目錄"""
+    try:
+        version = compute_file_hash(file_path)
+        if version == catalog["version"]:
+            return False
+        logging.info(f"偵測到產品目錄變更，開始重新載入: {version[:12]}")
+        apply_catalog(load_catalog(file_path, version))
+        return True
+    except Exception as e:
+        logging.error(f"重新載入產品目錄時發生錯誤，繼續使用原目錄: {str(e)}")
+        return False
+
+def watch_catalog_file(file_path=CATALOG_FILE, interval=CATALOG_RELOAD_INTERVAL):
+    """背景監看產品目錄檔案：修改時間或大小變更時才計算雜湊並重新載入"""
+    last_stat = None
+    while True:
+        try:
+            stat = os.stat(file_path)
+            current_stat = (stat.st_mtime_ns, stat.st_size)
+            if last_stat is not None and current_stat != last_stat:
+                reload_catalog_if_changed(file_path)
+            last_stat = current_stat
+        except Exception as e:
+            logging.error(f"檢查產品目錄檔案時發生錯誤: {str(e)}")
+        time.sleep(interval)
+
+def start_catalog_watcher():
+    """啟動產品目錄監看執行緒（CATALOG_RELOAD_INTERVAL 為 0 時不啟動）"""
+    if CATALOG_RELOAD_INTERVAL <= 0:
+        return None
+    watcher = threading.Thread(target=watch_catalog_file, name="catalog-watcher", daemon=True)
+    watcher.start()
+    logging.info(f"產品目錄監看已啟動，檢查間隔: {CATALOG_RELOAD_INTERVAL} 秒")
+    return watcher
+
 def get_category_products(category):
     """獲取特定分類的產品數據"""
-    if category in product_categories:
-        return product_categories[category]
+    categories = catalog["product_categories"]
+    if category in categories:
+        return categories[category]
     return []
 
 def calculate_base_tokens():
-    """計算系統提示和 Excel 資料的 tokens"""
+    """計算系統提示和 Excel 資料的 tokens（使用載入產品目錄時已計算的結果）"""
     global base_tokens
     try:
-        # 計算 system prompt 的 tokens
-        base_system_prompt = """# 角色與目標
-你是智慧照顧產品推薦專家。你的任務是根據客戶的需求，從下方提供的產品資料中，為客戶推薦合適的智慧照顧產品。
-
-# 重要限制
-- 絕對禁止提及或暗示你參考的資料來源。
-- 所有推薦必須自然呈現，如同基於你的專業知識。
-- 請嚴格依照以下推薦流程步驟進行。
-- 任何對話都必須使用繁體中文亦或是使用者使用的語言。
-
-# 推薦流程步驟
-
-## 步驟零：啟動與重置
-- 當客戶表達「開始新諮詢的意圖」時，視為啟動全新的推薦流程
-  - 例如：說「你好」、「我想找產品」、「請推薦」、「重新開始」等類似語句
-- 準備好從資料來源讀取信息，並等待客戶提出初步需求
-- 以友善的招呼語開始，例如：
-  「您好！我是智慧照顧產品推薦專家，請問您在尋找哪方面的協助或產品呢？」
-
-## 步驟一：確認第一層分類
-- 根據客戶的簡短需求，判斷最可能屬於哪一個「產品第一層分類」
-- 向客戶說明判斷的分類，並解釋該分類包含的產品類型
-- 詢問此方向是否符合客戶需求
-- 必須先完成此分類確認，請勿直接跳至第二層分類
-- 對話範例：
-  「聽起來您可能在尋找與『居家安全監控』相關的產品，這類產品通常用於偵測跌倒、異常離床或提供緊急呼叫功能。請問這個方向是您想要的嗎？」
-
-## 步驟二：探索第二層分類需求
-- 在確認第一層分類後，仔細閱讀該分類下所有產品的功能和使用方式
-- 根據產品差異，提出具體問題引導客戶
-- 問題可圍繞：
-  - 功能偏好
-  - 使用場景
-  - 操作方式
-- 對話範例：
-  「為了更精確地推薦，請問您：
-  1. 比較重視『自動偵測並發出警報』（如跌倒偵測），還是『主動求助』（如緊急按鈕）的功能？
-  2. 對於安裝方式（固定式或穿戴式）您有特別偏好嗎？」
-
-## 步驟三：統整與確認需求
-- 統整所有需求資訊
-- 指出對應的「產品第二層分類」
-- 向客戶複述完整需求並請求確認
-- 確認範例：
-  「好的，讓我整理一下您的需求：
-  - 第一層分類：『居家安全監控』
-  - 特別需求：『自動偵測異常狀態，如跌倒』功能
-  - 偏好：非穿戴式設備
-  請問我的理解正確嗎？」
-
-## 步驟四：提供產品推薦
-- 在確認需求無誤後，從下方提供的「產品資訊」中篩選最符合的產品。
-- 至少推薦三項產品。
-- **對於每項推薦的產品，請務必使用提供的完整資訊，包含：**
-  1.  **產品名稱**
-  2.  **公司名稱**
-  3.  **主要功能與特色**
-  4.  **產品網址**
-  5.  **廠商連絡電話**
-
-## 步驟五：滿意度詢問與後續
-- 詢問：「請問以上推薦的產品是否符合您的期待？」
-- 如果滿意：
-  「如果您對這次的推薦感到滿意，請在下方提供您的電子郵件地址，我會將推薦結果整理後寄送給您。」
-- 如果不滿意：
-  - 回到步驟二重新詢問需求。
-  - 必要時回到步驟一重新確認分類。
-  - 根據新資訊調整推薦。
-"""
-        system_tokens = calculate_system_tokens()
-        
-        # 計算 Excel 資料的 tokens
-        excel_text = ""
-        for category, products in product_categories.items():
-            for product in products:
-                product_text = (
-                    f"產品名稱：{product.get('產品名稱', 'N/A')}\n"
-                    f"公司名稱：{product.get('公司名稱', 'N/A')}\n"
-                    f"主要功能：{product.get('主要功能', 'N/A')}\n"
-                    f"使用方式：{product.get('使用方式', 'N/A')}\n"
-                    f"產品網址：{product.get('產品網址', 'N/A')}\n"
-                    f"連絡電話：{product.get('連絡電話', 'N/A')}\n"
-                    f"分類：{product.get('產品第一層分類', 'N/A')} > {product.get('產品第二層分類', 'N/A')}\n"
-                )
-                excel_text += product_text
-        
-        excel_tokens = calculate_excel_tokens()
-        
         # 總基礎 tokens
         base_tokens = system_tokens + excel_tokens
         logging.info(f"基礎 tokens 計算完成 - 系統提示: {system_tokens}, Excel 資料: {excel_tokens}")
@@ -372,51 +1506,669 @@ try:
 except Exception as e:
     logging.error(f"初始化基礎 tokens 時發生錯誤: {str(e)}")
 
-def calculate_api_cost(response, is_new_conversation=False):
-    """計算 API 使用成本"""
-    global api_cost
+def calculate_api_cost(usage, session, is_new_conversation=False):
+    """依回應的 usage 計算 API 使用成本，並累計到會話"""
     try:
         # 獲取輸入和輸出的 token 數量
-        prompt_tokens = response.usage.prompt_tokens
-        completion_tokens = response.usage.completion_tokens
+        prompt_tokens = usage["prompt_tokens"]
+        completion_tokens = usage["completion_tokens"]
+        # 命中提示詞快取的輸入 tokens 以較低的單價計算
+        cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
         
         # 記錄詳細的 tokens 信息
         if is_new_conversation:
-            logging.info(f"新對話 tokens 明細:")
-            logging.info(f"- 系統提示+產品資料 tokens: {prompt_tokens}")
-            logging.info(f"- 總輸入 tokens: {prompt_tokens}")
+            log_detail(f"新對話 tokens 明細:")
+            log_detail(f"- 系統提示+產品資料 tokens: {prompt_tokens}")
+            log_detail(f"- 總輸入 tokens: {prompt_tokens}")
         else:
-            logging.info(f"持續對話 tokens 明細:")
-            logging.info(f"- 輸入 tokens: {prompt_tokens}")
+            log_detail(f"持續對話 tokens 明細:")
+            log_detail(f"- 輸入 tokens: {prompt_tokens}")
         
         # gpt-4.1-mini-2025-04-14 的定價
         input_cost_per_1M = 0.40  # 每 1,000,000 個輸入 token 的價格 ($0.40/1M)
+        cached_input_cost_per_1M = 0.10  # 每 1,000,000 個快取輸入 token 的價格 ($0.10/1M)
         output_cost_per_1M = 1.60  # 每 1,000,000 個輸出 token 的價格 ($1.60/1M)
         
         # 計算本次請求的成本
-        input_cost = (prompt_tokens / 1000000) * input_cost_per_1M
+        input_cost = ((prompt_tokens - cached_tokens) / 1000000) * input_cost_per_1M
+        cached_input_cost = (cached_tokens / 1000000) * cached_input_cost_per_1M
         output_cost = (completion_tokens / 1000000) * output_cost_per_1M
-        total_cost = input_cost + output_cost
+        total_cost = input_cost + cached_input_cost + output_cost
         
-        # 更新總成本
-        api_cost += total_cost
+        # 更新會話總成本
+        session["api_cost"] += total_cost
         
         # 記錄詳細的成本信息
-        logging.info(f"API 成本計算 - 輸入tokens: {prompt_tokens}, 輸出tokens: {completion_tokens}")
-        logging.info(f"成本明細 - 輸入成本: ${input_cost:.6f}, 輸出成本: ${output_cost:.6f}, 總成本: ${total_cost:.6f}")
-        logging.info(f"單價 - 輸入: ${input_cost_per_1M}/1M tokens, 輸出: ${output_cost_per_1M}/1M tokens")
-        logging.info(f"累計總成本: ${api_cost:.6f}")
+        log_detail(f"API 成本計算 - 輸入tokens: {prompt_tokens}（快取 {cached_tokens}）, 輸出tokens: {completion_tokens}")
+        log_detail(f"成本明細 - 輸入成本: ${input_cost:.6f}, 快取輸入成本: ${cached_input_cost:.6f}, 輸出成本: ${output_cost:.6f}, 總成本: ${total_cost:.6f}")
+        log_detail(f"單價 - 輸入: ${input_cost_per_1M}/1M tokens, 快取輸入: ${cached_input_cost_per_1M}/1M tokens, 輸出: ${output_cost_per_1M}/1M tokens")
+        log_detail(f"會話累計總成本: ${session['api_cost']:.6f}")
         
-        return total_cost, api_cost
+        return total_cost, session["api_cost"]
     except Exception as e:
         logging.error(f"計算 API 成本時發生錯誤: {str(e)}")
-        return 0.0, api_cost
+        return 0.0, session["api_cost"]
+
+class TokenBucket:
+    """非同步令牌桶限流器，容量為每分鐘的額度"""
+
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.rate = rate_per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        """取得指定數量的令牌，額度不足時依補充速率等待（依到達順序）"""
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class OpenAIUnavailableError(Exception):
+    """重試後仍失敗或斷路器開啟，上游暫時無法使用"""
+
+
+class CircuitBreaker:
+    """連續失敗（重試用盡）的呼叫達門檻時開啟，冷卻期間直接拒絕請求；冷卻後只放行一個試探請求，成功才關閉"""
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def is_open(self):
+        return self.opened_at is not None and time.monotonic() - self.opened_at < self.cooldown
+
+    def remaining(self):
+        """距離冷卻結束的秒數，未開啟時為 0"""
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if self.is_open() or self.trial:
+            return False
+        self.trial = True
+        return True
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logging.info("OpenAI 斷路器關閉，恢復正常呼叫")
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def release_trial(self):
+        """試探請求被取消或提前關閉時未能判斷結果，讓下一個請求重新試探"""
+        self.trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.trial or (self.opened_at is None and self.failures >= self.threshold):
+            logging.warning(f"OpenAI 連續失敗 {self.failures} 次，斷路器開啟 {self.cooldown} 秒")
+            self.opened_at = time.monotonic()
+        self.trial = False
+
+
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError, openai.error.APIConnectionError, openai.error.ServiceUnavailableError,
+    openai.error.Timeout, openai.error.TryAgain, asyncio.TimeoutError, aiohttp.ClientError
+)
+
+def is_retryable(error):
+    """逾時、連線錯誤、429 及 5xx 可以重試；其他（例如 400、401）重試也不會成功"""
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    return isinstance(error, openai.error.APIError) and (error.http_status or 500) >= 500
+
+def describe_error(error):
+    """日誌用的簡短錯誤說明（openai 的錯誤訊息可能包含整個回應內容）"""
+    return (str(error) or type(error).__name__)[:200]
+
+def get_retry_after(error):
+    """上游指定的重試等待秒數（Retry-After 或 retry-after-ms 標頭），沒有時回傳 None"""
+    headers = {str(k).lower(): v for k, v in (getattr(error, "headers", None) or {}).items()}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+def get_retry_delay(error, attempt):
+    """指數退避加上完全隨機抖動，避免大量請求同時重試；上游指定 Retry-After 時至少等待該秒數"""
+    delay = random.uniform(0, min(OPENAI_RETRY_MAX_DELAY, OPENAI_RETRY_BASE_DELAY * 2 ** attempt))
+    retry_after = get_retry_after(error)
+    return max(delay, retry_after) if retry_after is not None else delay
+
+
+class OpenAIDispatcher:
+    """限制同時進行的 OpenAI 請求數，並依 API 等級的 RPM/TPM 限流
+
+    每次嘗試都有逾時限制，可重試的錯誤以抖動的指數退避重試；連續失敗時由斷路器直接拒絕請求。
+    啟用 OPENAI_HEDGE 時，超過近期 p95 仍未取得第一個區塊就送出相同的請求，採用先回應者。
+    """
 
-def query_chatgpt(user_input, state, email):
-    global conversation, current_step, api_cost, system_prompt_loaded
+    HEDGE_MIN_SAMPLES = 20  # 累積足夠樣本後才依 p95 對沖
+    STARTED = object()  # _attempt 取得並發名額後產生的標記
+    LATENCY_WINDOW = 200
+
+    def __init__(self, max_concurrency, rpm_limit, tpm_limit):
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.waiting = 0
+        self.breaker = CircuitBreaker(OPENAI_BREAKER_THRESHOLD, OPENAI_BREAKER_COOLDOWN)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._request_bucket = TokenBucket(rpm_limit)
+        self._token_bucket = TokenBucket(tpm_limit)
+        self._http_session = None
+        self._latencies = {True: deque(maxlen=self.LATENCY_WINDOW), False: deque(maxlen=self.LATENCY_WINDOW)}
+
+    def _get_http_session(self):
+        # 共用 aiohttp 連線池，避免每個請求重新建立 TCP/TLS 連線
+        if self._http_session is None or self._http_session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+            self._http_session = aiohttp.ClientSession(connector=connector)
+        return self._http_session
+
+    @contextlib.asynccontextmanager
+    async def _slot(self, estimated_tokens, model):
+        """等待並發名額與 RPM/TPM 限流，區塊內計入 in_flight 並記錄呼叫耗時"""
+        queued = True
+        self.waiting += 1
+        try:
+            async with self._semaphore:
+                await self._request_bucket.acquire()
+                if estimated_tokens:
+                    await self._token_bucket.acquire(estimated_tokens)
+                self.waiting -= 1
+                queued = False
+                openai.aiosession.set(self._get_http_session())
+                self.in_flight += 1
+                started = time.perf_counter()
+                try:
+                    yield
+                except Exception:
+                    OPENAI_ERRORS.inc(model=model)
+                    raise
+                finally:
+                    self.in_flight -= 1
+                    OPENAI_LATENCY.observe(time.perf_counter() - started, model=model)
+        finally:
+            if queued:
+                self.waiting -= 1
+
+    async def _attempt(self, estimated_tokens, kwargs, stream):
+        """單次呼叫；取得並發名額及通過限流後先產生 STARTED，非串流時再產生一次完整回應，讓串流與非串流共用重試及對沖的流程"""
+        async with self._slot(estimated_tokens, kwargs.get("model")):
+            yield self.STARTED
+            if not stream:
+                yield await openai.ChatCompletion.acreate(**kwargs)
+                return
+            response = await openai.ChatCompletion.acreate(
+                stream=True,
+                stream_options={"include_usage": True},
+                **kwargs
+            )
+            async for chunk in response:
+                yield chunk
+
+    def _hedge_delay(self, stream):
+        if not OPENAI_HEDGE:
+            return None
+        latencies = sorted(self._latencies[stream])
+        if len(latencies) < self.HEDGE_MIN_SAMPLES:
+            return None
+        return max(OPENAI_HEDGE_MIN_DELAY, latencies[math.ceil(0.95 * len(latencies)) - 1])
+
+    async def _first(self, estimated_tokens, kwargs, stream):
+        """取得第一個區塊，回傳 (呼叫, 第一個區塊)；超過對沖延遲仍未取得時送出相同的請求，採用先回應者
+
+        逾時、對沖時間與延遲樣本都從取得並發名額及通過 RPM/TPM 限流後才開始計算，本地排隊不算上游逾時。
+        """
+        hedge_delay = self._hedge_delay(stream)
+        hedge_at = None
+        hedged = False
+        pending = {}  # task -> (呼叫, 送出時間；仍在本地排隊時為 None)
+        error = None
+
+        def launch():
+            attempt = self._attempt(estimated_tokens, kwargs, stream)
+            pending[asyncio.ensure_future(attempt.__anext__())] = (attempt, None)
+
+        launch()
+        try:
+            while pending:
+                wakes = [started + OPENAI_TIMEOUT for _, started in pending.values() if started is not None]
+                if hedge_at is not None:
+                    wakes.append(hedge_at)
+                timeout = max(0.0, min(wakes) - time.monotonic()) if wakes else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    attempt, started = pending.pop(task)
+                    try:
+                        first = task.result()
+                    except StopAsyncIteration:
+                        first = None
+                    except Exception as e:
+                        error = e
+                        await attempt.aclose()
+                        continue
+                    if first is self.STARTED:
+                        # 已送出請求，開始計算此呼叫的逾時；第一個送出的呼叫另開始計算對沖時間
+                        started = time.monotonic()
+                        pending[asyncio.ensure_future(attempt.__anext__())] = (attempt, started)
+                        if hedge_delay is not None and not hedged and hedge_at is None:
+                            hedge_at = started + hedge_delay
+                        continue
+                    self._latencies[stream].append(time.monotonic() - started)
+                    return attempt, first
+                now = time.monotonic()
+                for task, (attempt, started) in list(pending.items()):
+                    if started is not None and now >= started + OPENAI_TIMEOUT:
+                        del pending[task]
+                        task.cancel()
+                        with contextlib.suppress(BaseException):
+                            await task
+                        await attempt.aclose()
+                        error = asyncio.TimeoutError(f"{OPENAI_TIMEOUT} 秒內未收到回應")
+                if hedge_at is not None and now >= hedge_at and pending:
+                    hedge_at = None
+                    hedged = True
+                    OPENAI_HEDGES.inc(model=kwargs.get("model"))
+                    log_detail("OpenAI 回應超過近期 p95，送出對沖請求")
+                    launch()
+            raise error
+        finally:
+            # 未被採用的呼叫立即取消，釋放並發名額
+            for task, (attempt, _) in pending.items():
+                task.cancel()
+                with contextlib.suppress(BaseException):
+                    await task
+                await attempt.aclose()
+
+    async def _request(self, estimated_tokens, kwargs, stream):
+        model = kwargs.get("model")
+        attempt = 0
+        owns_trial = False
+        try:
+            while True:
+                if not self.breaker.allow():
+                    raise OpenAIUnavailableError("OpenAI 斷路器開啟中，暫停呼叫")
+                owns_trial = self.breaker.trial
+                try:
+                    response, first = await self._first(estimated_tokens, kwargs, stream)
+                    break
+                except Exception as e:
+                    if not is_retryable(e):
+                        self.breaker.record_success()  # 請求本身的錯誤不代表上游異常
+                        raise
+                    # 只有重試用盡的呼叫才計入斷路器，偶發的錯誤由重試處理；試探請求失敗則立即重新開啟
+                    if attempt >= OPENAI_MAX_RETRIES or self.breaker.trial or self.breaker.is_open():
+                        self.breaker.record_failure()
+                        raise OpenAIUnavailableError(f"OpenAI 呼叫失敗（已嘗試 {attempt + 1} 次）: {describe_error(e)}") from e
+                    delay = get_retry_delay(e, attempt)
+                    attempt += 1
+                    OPENAI_RETRIES.inc(model=model)
+                    logging.warning(f"OpenAI 呼叫失敗，{delay:.2f} 秒後第 {attempt} 次重試: {describe_error(e)}")
+                    await asyncio.sleep(delay)
+
+            # 已開始輸出後的錯誤無法透明重試，直接視為上游無法使用
+            try:
+                if first is not None:
+                    yield first
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(response.__anext__(), OPENAI_TIMEOUT)
+                    except StopAsyncIteration:
+                        break
+                    yield chunk
+                self.breaker.record_success()
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                self.breaker.record_failure()
+                raise OpenAIUnavailableError(f"OpenAI 串流中斷: {describe_error(e)}") from e
+            finally:
+                await response.aclose()
+        finally:
+            # 試探請求被取消（CancelledError）或呼叫端提前關閉串流（GeneratorExit）時沒有結果，
+            # 不釋放的話斷路器會一直拒絕請求
+            if owns_trial and self.breaker.trial:
+                self.breaker.release_trial()
+
+    async def create(self, estimated_tokens=0, **kwargs):
+        """在並發與速率限制下呼叫 ChatCompletion"""
+        result = None
+        # 讀完整個產生器，呼叫結束時立即釋放並發名額
+        async for response in self._request(estimated_tokens, kwargs, stream=False):
+            result = response
+        return result
+
+    async def stream(self, estimated_tokens=0, **kwargs):
+        """以串流方式呼叫 ChatCompletion，整個串流期間都佔用一個並發名額"""
+        # 呼叫端提前關閉串流時一併關閉內層產生器，立即釋放並發名額
+        async with contextlib.aclosing(self._request(estimated_tokens, kwargs, stream=True)) as chunks:
+            async for chunk in chunks:
+                yield chunk
+
+
+_dispatchers = weakref.WeakKeyDictionary()
+
+def get_dispatcher():
+    """取得目前事件循環使用的 OpenAI 調度器（asyncio 原語不可跨事件循環共用）"""
+    loop = asyncio.get_running_loop()
+    dispatcher = _dispatchers.get(loop)
+    if dispatcher is None:
+        dispatcher = OpenAIDispatcher(OPENAI_MAX_CONCURRENCY, OPENAI_RPM_LIMIT, OPENAI_TPM_LIMIT)
+        _dispatchers[loop] = dispatcher
+    return dispatcher
+
+def estimate_prompt_tokens(messages):
+    """粗略估計請求的 tokens（以字元數計），用於 TPM 限流"""
+    return sum(len(message["content"]) for message in messages)
+
+def build_chat_history(conversation):
+    """將對話歷史轉換為 (用戶, 助理) 配對，跳過系統消息"""
+    chat_history = []
+    pending_user_message = None
+    for message in conversation:
+        if message["role"] == "user":
+            pending_user_message = message["content"]
+        elif message["role"] == "assistant" and pending_user_message is not None:
+            chat_history.append((pending_user_message, message["content"]))
+            pending_user_message = None
+    return chat_history
+
+def merge_chat_history(chatbot, conversation, user_input, reply):
+    """以會話歷史更新聊天視窗中已完成的回合，本輪回覆放在最後
+
+    事件觸發時的聊天視窗快照可能已過時（例如前一輪仍在串流時排隊的訊息），直接寫回會覆蓋前一輪的完整回覆；
+    歷史中已刪減或併入摘要的較早回合沿用快照中的顯示。
+    """
+    rows = list(chatbot or [])
+    # 快照最後一列是本輪的訊息（重複送出時為進行中的同一則訊息）
+    if rows and rows[-1][0] and ResponseCache.normalize(rows[-1][0]) == ResponseCache.normalize(user_input):
+        rows = rows[:-1]
+    history = build_chat_history(conversation)
+    # 本輪已寫入歷史時（本地回覆或已完成），以實際顯示的回覆取代
+    if history and ResponseCache.normalize(history[-1][0]) == ResponseCache.normalize(user_input):
+        history = history[:-1]
+    return rows[:max(0, len(rows) - len(history))] + history + [(user_input, reply)]
+
+def fit_request_to_context(session):
+    """請求前依 tokens 帳本檢查輸入大小，超過上下文限制時刪除最早的對話
+
+    回傳本次請求可用的 max_tokens；僅剩系統消息與最新一條消息仍超過限制時回傳 None。
+    """
+    conversation = session["conversation"]
+    limit = MODEL_CONTEXT_LIMIT - MIN_COMPLETION_TOKENS
+    start = count_leading_system_messages(conversation)
+    # 即使刪除所有較早的對話也無法符合限制時，直接拒絕而不刪除歷史
+    minimal_tokens = (sum(m["tokens"] for m in conversation[:start] + conversation[-1:])
+                      + get_focus_tokens(session) + REPLY_PRIMING_TOKENS)
+    if minimal_tokens > limit:
+        return None
+    while get_prompt_tokens(session) > limit and len(conversation) - start > 1:
+        # 刪除最早的一輪對話（至下一條用戶消息為止）
+        end = start + 1
+        while end < len(conversation) - 1 and conversation[end]["role"] != "user":
+            end += 1
+        set_messages(session, start, end, [])
+        logging.warning(f"請求超過上下文限制，刪除最早的對話 - 目前輸入 tokens: {get_prompt_tokens(session)}")
+    return min(MAX_COMPLETION_TOKENS, MODEL_CONTEXT_LIMIT - get_prompt_tokens(session))
+
+def render_conversation_summary(category, needs):
+    """將已確認的分類與客戶需求整理為摘要消息"""
+    lines = [
+        "==== 先前對話摘要 ====",
+        f"已確認的第一層分類：{category or '尚未確認'}",
+        "客戶已提出的需求："
+    ]
+    lines.extend(f"- {need}" for need in needs)
+    lines.append("==== 摘要結束 ====")
+    return "\n".join(lines)
+
+async def summarize_with_model(previous_summary, messages):
+    """以低成本模型將較早的對話整理為摘要條目，每行一條需求"""
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    response = await get_dispatcher().create(
+        estimated_tokens=estimate_prompt_tokens(messages),
+        model=COMPACTION_MODEL,
+        messages=[
+            {"role": "system", "content": (
+                "請將以下智慧照顧產品諮詢的對話整理為客戶需求清單，每行一條，只列出客戶已確認的需求、"
+                "偏好與使用情境，不要加入其他說明。"
+            )},
+            {"role": "user", "content": f"先前摘要：\n{previous_summary}\n\n對話：\n{transcript}"}
+        ]
+    )
+    content = response["choices"][0]["message"]["content"]
+    return [line.strip("-• ").strip() for line in content.splitlines() if line.strip("-• ").strip()]
+
+async def compact_conversation(session, state):
+    """對話超過 PROMPT_TOKEN_BUDGET 時，將較早的對話輪次併入摘要，保留系統提示和最近的對話原文"""
+    conversation = session["conversation"]
+    total_tokens = get_prompt_tokens(session)
+    # 共用前綴由供應商快取，預算只計算其後的對話
+    prefix_tokens = conversation[0]["tokens"] if PROMPT_CACHE_LAYOUT and conversation and conversation[0]["role"] == "system" else 0
+    if total_tokens - prefix_tokens <= PROMPT_TOKEN_BUDGET:
+        return
+
+    # 找出要保留原文的最近 COMPACTION_KEEP_TURNS 輪（以用戶消息為每輪的開始）
+    start = count_leading_system_messages(conversation)
+    # 至少保留最新一輪，否則剛送出的用戶消息會被併入摘要，請求中沒有用戶消息
+    keep_turns = max(COMPACTION_KEEP_TURNS, 1)
+    user_positions = [i for i in range(start, len(conversation)) if conversation[i]["role"] == "user"]
+    if len(user_positions) <= keep_turns:
+        return
+    keep_from = user_positions[-keep_turns]
+    folded = conversation[start:keep_from]
+
+    needs = session["summary_needs"]
+    new_needs = None
+    if COMPACTION_MODEL:
+        try:
+            new_needs = await summarize_with_model("\n".join(needs), folded)
+            needs = []
+        except Exception as e:
+            logging.error(f"以模型產生對話摘要時發生錯誤，改用本地摘要: {str(e)}")
+    if new_needs is None:
+        new_needs = [m["content"].strip()[:200] for m in folded if m["role"] == "user" and not is_navigation_input(m["content"])]
+    for need in new_needs:
+        if need and need not in needs:
+            needs.append(need)
+    session["summary_needs"] = needs[-COMPACTION_MAX_NEEDS:]
+
+    summary = render_conversation_summary(state.get("current_category"), session["summary_needs"])
+    # 系統提示之後只保留一條摘要消息
+    prefix = 1 if start else 0
+    set_messages(session, prefix, keep_from, [make_message("system", summary)])
+    logging.info(f"對話壓縮完成 - 併入 {len(folded)} 條消息, 壓縮前 tokens: {total_tokens}, "
+                 f"壓縮後 tokens: {get_prompt_tokens(session)}")
+
+# 郵件寄送設定（可指向本地 SMTP 伺服器，例如 aiosmtpd，進行測試）
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "1") != "0"
+SMTP_IDLE_TIMEOUT = float(os.getenv("SMTP_IDLE_TIMEOUT", 60))  # SMTP 連線閒置超過此秒數即關閉，下次寄送時重新連線
+EMAIL_OUTBOX_DIR = os.getenv("EMAIL_OUTBOX_DIR", ".email_outbox")  # 待寄郵件的存放目錄，重啟後繼續寄送
+EMAIL_MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", 5))  # 每封郵件的寄送嘗試次數上限
+EMAIL_RETRY_BACKOFF = float(os.getenv("EMAIL_RETRY_BACKOFF", 5))  # 重試等待秒數，每次失敗後加倍
+EMAIL_SUBJECT = "智慧照顧產品推薦結果"
+EMAIL_DISCLAIMER = "\n\n免責聲明: 本系統僅為參考，所有產品資訊請以實際產品網頁為主，詳細信息請查閱相關網站。"
+
+# 推薦流程（對應系統提示中的步驟零至步驟五），state["step"] 記錄目前所在步驟
+FLOW_STEPS = ["步驟零", "步驟一", "步驟二", "步驟三", "步驟四", "步驟五"]
+WELCOME_MESSAGE = "您好！我是智慧照顧產品推薦專家，請問您在尋找哪方面的協助或產品呢？"
+DEGRADED_REPLY_PREFIX = "抱歉，推薦服務目前暫時無法使用"
+GREETING_INPUTS = {"你好", "您好", "哈囉", "嗨", "hi", "hello", "開始", "重新開始", "我想找產品", "請推薦"}
+MENU_INPUTS = {"分類", "產品分類", "有哪些分類", "有什麼分類", "有哪些產品", "有什麼產品", "選單", "目錄"}
+
+def is_navigation_input(text):
+    """招呼、分類選單及選單編號等操作性輸入，不是客戶的需求，不列入對話摘要"""
+    text = ResponseCache.normalize(text)
+    return not text or text in GREETING_INPUTS or text in MENU_INPUTS or text.isdigit()
+
+# 模型回覆中代表進入各步驟的用語，依序比對
+STEP_MARKERS = [
+    (5, ("是否符合您的期待",)),
+    (4, ("產品網址", "連絡電話")),
+    (3, ("理解正確",)),
+    (2, ("為了更精確地推薦",)),
+    (1, ("這個方向",)),
+]
+EMAIL_PATTERN = re.compile(r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+')
+
+def get_category_label(category):
+    """去除分類名稱前的編號，例如「(1) 長者日常照顧…」→「長者日常照顧…」"""
+    return re.sub(r'^\(\d+\)\s*', '', category).strip()
+
+def render_category_menu(categories):
+    """步驟一的分類選單"""
+    lines = [
+        f"{i}. {get_category_label(category)}（{len(products)} 項產品）"
+        for i, (category, products) in enumerate(categories.items(), 1)
+    ]
+    return "目前提供以下產品分類：\n" + "\n".join(lines) + "\n\n請輸入分類編號或名稱，或直接描述您的需求。"
+
+def render_category_confirmation(category, products):
+    """確認第一層分類並列出其第二層分類，引導進入步驟二"""
+    subcategories = list(dict.fromkeys(p.subcategory for p in products if p.subcategory))
+    reply = f"好的，我們以『{get_category_label(category)}』為方向，這類共有 {len(products)} 項產品"
+    if subcategories:
+        reply += "，涵蓋：" + "、".join(subcategories)
+    return reply + "。\n\n為了更精確地推薦，請描述使用者的狀況、使用場景，或您最重視的功能。"
+
+def match_category(text, categories, allow_number=False):
+    """以分類名稱（可省略編號）或選單編號比對第一層分類，text 需已正規化"""
+    names = list(categories)
+    if allow_number:
+        match = re.fullmatch(r'(?:第\s*)?\(?(\d+)\)?\s*(?:類|項)?', text)
+        if match and 1 <= int(match.group(1)) <= len(names):
+            return names[int(match.group(1)) - 1]
+    for name in names:
+        if text in (ResponseCache.normalize(name), ResponseCache.normalize(get_category_label(name))):
+            return name
+    return None
+
+def answer_locally(user_input, state, session_id="default"):
+    """招呼、分類選單、分類確認及步驟五的電子郵件收集不需模型判斷，直接在本地回覆；其他情況回傳 None"""
+    if not LOCAL_FLOW_ENABLED:
+        return None
+    text = ResponseCache.normalize(user_input)
+    session = session_store.get(session_id, refresh=False)
+    categories = session["catalog"]["product_categories"]
+    step = state.get("step", 0)
+
+    if text in GREETING_INPUTS:
+        session = session_store.reset(session_id)
+        reset_flow_state(state)
+        reply = WELCOME_MESSAGE
+    elif text in MENU_INPUTS:
+        state["step"] = 1
+        state["awaiting_category"] = True
+        reply = render_category_menu(categories)
+    else:
+        category = match_category(text, categories, state.get("awaiting_category")) if step <= 1 else None
+        email_match = EMAIL_PATTERN.search(user_input) if step == 5 else None
+        if category:
+            state["step"] = 2
+            state["current_category"] = category
+            state["awaiting_category"] = False
+            reply = render_category_confirmation(category, categories[category])
+        elif email_match:
+            state["email"] = email_match.group(0)
+            reply = f"已記錄您的電子郵件：{state['email']}。請點選「寄送郵件」按鈕，我會將推薦結果寄送給您。"
+        else:
+            return None
+
+    append_message(session, "user", user_input)
+    append_message(session, "assistant", reply)
+    session_store.trim(session)
+    log_detail(f"本地回覆 - 會話: {session_id}, 目前步驟: {FLOW_STEPS[state['step']]}")
+    return reply
+
+def render_degraded_reply(user_input, state, conversation, active_catalog):
+    """上游無法使用時不呼叫模型，依目前的需求以檢索列出可能相關的產品"""
+    needs = "\n".join([m["content"] for m in conversation if m["role"] == "user"] + [user_input])
+    category = state.get("current_category")
+    if category not in active_catalog["product_categories"]:
+        category = None
+    index = active_catalog["product_index"]
+    matches = index.search(needs, 3, category=category, min_score=RETRIEVAL_MIN_SCORE)
+    if not matches:
+        return f"{DEGRADED_REPLY_PREFIX}，請稍後再試。"
+    lines = [f"{DEGRADED_REPLY_PREFIX}。以下先依您目前的描述列出可能相關的產品供參考，請稍後再試一次以取得完整的推薦與說明："]
+    for number, i in enumerate(matches, 1):
+        product = index.products[i]
+        lines.append(
+            f"{number}. {product.get('產品名稱', 'N/A')}（{product.get('公司名稱', 'N/A')}）\n"
+            f"   產品網址：{product.get('產品網址', 'N/A')}\n"
+            f"   連絡電話：{product.get('連絡電話', 'N/A')}"
+        )
+    return "\n".join(lines)
+
+def record_mentions(reply, state, active_catalog):
+    """一次掃描回覆，更新目前分類並記錄推薦的產品編號，回傳本輪提到的產品編號"""
+    found = active_catalog["matcher"].scan(reply)
+    if found["category"]:
+        state["current_category"] = found["category"][0]
+    product_ids = found["product"]
+    if product_ids:
+        state["recommended_products"] = product_ids
+        products = active_catalog["products"]
+        for product_id in product_ids:
+            PRODUCT_RECOMMENDATIONS.inc(category=products[product_id].category)
+        # 回覆只提到產品時，以第一個產品的分類作為目前分類
+        if not found["category"]:
+            state["current_category"] = products[product_ids[0]].category
+    return product_ids
+
+def advance_step(state, reply):
+    """依模型回覆推進 state["step"]；未出現各步驟用語時，步驟零之後進入步驟一"""
+    step = state.get("step", 0)
+    for marker_step, markers in STEP_MARKERS:
+        if any(marker in reply for marker in markers):
+            step = marker_step
+            break
+    else:
+        step = max(step, 1)
+    state["step"] = step
+    state["awaiting_category"] = False
+
+def drop_unanswered_message(session, user_input):
+    """移除沒有得到回覆的用戶消息，避免下一輪出現連續兩條用戶消息，稍後重新送出時對話保持一致"""
+    conversation = session["conversation"]
+    if conversation and conversation[-1]["role"] == "user" and conversation[-1]["content"] == user_input:
+        set_messages(session, len(conversation) - 1, len(conversation), [])
+
+async def stream_chatgpt(user_input, state, email, session_id="default"):
+    """以串流方式查詢 ChatGPT，每收到新內容就產生目前累積的回覆，最後一次包含成本資訊"""
+    started = time.perf_counter()
+    begin_turn_logging(session_id, state)
+    session = await session_store.fetch(session_id)
+    # 流程狀態與會話一起保存，重啟後可繼續
+    session["state"] = state
+    conversation = session["conversation"]
     
     # 將debug信息添加到日誌
-    logging.info(f"查詢前狀態 - system_prompt_loaded: {system_prompt_loaded}, 對話長度: {len(conversation)}")
+    log_detail(f"查詢前狀態 - 會話: {session_id}, system_prompt_loaded: {session['system_prompt_loaded']}, 對話長度: {len(conversation)}")
     
     # 判斷是否是新對話
     is_new_conversation = (
@@ -427,191 +2179,483 @@ def query_chatgpt(user_input, state, email):
     )
     
     try:
+        # 確定性的步驟直接在本地回覆，不呼叫模型
+        local_reply = answer_locally(user_input, state, session_id)
+        if local_reply is not None:
+            await session_store.commit(session_id)
+            log_turn(started, "local")
+            yield local_reply
+            return
+
         # 如果是新對話，清空對話歷史和系統提示狀態
         if is_new_conversation:
-            conversation = []
-            system_prompt_loaded = False
-            logging.info(f"開始新對話 - 基礎 tokens: 系統提示({system_tokens}) + Excel資料({excel_tokens}) = {system_tokens + excel_tokens}")
-            logging.info(f"重置系統提示狀態: system_prompt_loaded = {system_prompt_loaded}")
+            session = session_store.reset(session_id)
+            conversation = session["conversation"]
+            reset_flow_state(state)
+            log_detail(f"開始新對話 - 基礎 tokens: 系統提示({system_tokens}) + Excel資料({excel_tokens}) = {system_tokens + excel_tokens}")
+            log_detail(f"重置系統提示狀態: system_prompt_loaded = {session['system_prompt_loaded']}")
         
-        # 僅保留系統提示，不限制對話歷史長度
+        # 保留系統提示，對話歷史長度由 session_store.trim 限制
         if len(conversation) > 0 and conversation[0]["role"] == "system":
             # 確保系統提示仍然保持為第一條消息
-            logging.info(f"對話繼續，保留系統提示在第一位置")
+            log_detail(f"對話繼續，保留系統提示在第一位置")
         
-        # 只在系統提示未加載時加載
-        if not system_prompt_loaded:
-            logging.info("需要加載系統提示")
-            relevant_products = []
-            if "current_category" in state and state["current_category"]:
-                products = product_categories.get(state["current_category"], [])
-                relevant_products.extend(products)
-            else:
-                for category, products in product_categories.items():
-                    relevant_products.extend(products)
-    
-            # 將產品資訊轉換為更清晰的格式
-            products_info = []
-            for product in relevant_products:
-                product_info = (
-                    f"產品名稱：{product.get('產品名稱', 'N/A')}\n"
-                    f"公司名稱：{product.get('公司名稱', 'N/A')}\n"
-                    f"主要功能：{product.get('主要功能', 'N/A')}\n"
-                    f"使用方式：{product.get('使用方式', 'N/A')}\n"
-                    f"產品網址：{product.get('產品網址', 'N/A')}\n"
-                    f"連絡電話：{product.get('連絡電話', 'N/A')}\n"
-                    f"分類：{product.get('產品第一層分類', 'N/A')} > {product.get('產品第二層分類', 'N/A')}\n"
-                    f"---"
-                )
-                products_info.append(product_info)
-    
-            # 添加分類資訊
-            categories_info = "可用分類：\n" + "\n".join([f"- {cat}" for cat in product_categories.keys()])
-            
-            # 組合完整的system prompt
-            system_prompt = (
-                base_system_prompt + "\n\n" +
-                categories_info + "\n\n" +
-                "==== 產品資訊 ====\n" + "\n".join(products_info) + "\n==== 產品資訊結束 ===="
+        if PROMPT_CACHE_LAYOUT:
+            # 系統提示在會話中不再改寫，同一目錄版本的所有會話位元組完全相同，可命中供應商的提示詞快取
+            if not session["system_prompt_loaded"]:
+                content, tokens = build_cache_prefix(session["catalog"])
+                set_messages(session, 0, 0, [{"role": "system", "content": content, "tokens": tokens + MESSAGE_OVERHEAD_TOKENS}])
+                session["system_prompt_loaded"] = True
+                log_detail("已添加共用的系統提示到對話歷史中")
+            # 分類與檢索結果每輪更新，只放在聚焦消息中
+            focus = build_focus_message(state, conversation, user_input, session["catalog"])
+            session["focus"] = make_message("system", focus) if focus else None
+        # 只在系統提示未加載時加載；使用檢索時依最新需求更新注入的產品
+        elif not session["system_prompt_loaded"] or session.get("uses_retrieval"):
+            log_detail("需要加載系統提示")
+            system_prompt, product_count, session["uses_retrieval"] = build_system_prompt(
+                state, conversation, user_input, session["catalog"]
             )
+            log_detail(f"系統提示產品數: {product_count}, 使用檢索: {session['uses_retrieval']}")
             
             # 將系統提示添加為第一條消息，確保清除之前的對話歷史
             if len(conversation) > 0 and conversation[0]["role"] == "system":
                 # 如果已有system消息，替換它
-                conversation[0] = {"role": "system", "content": system_prompt}
+                set_messages(session, 0, 1, [make_message("system", system_prompt)])
             else:
                 # 否則添加新的system消息
-                conversation.insert(0, {"role": "system", "content": system_prompt})
+                set_messages(session, 0, 0, [make_message("system", system_prompt)])
             
-            system_prompt_loaded = True
-            logging.info("已添加系統提示和產品資訊到對話歷史中")
-            logging.info(f"系統提示狀態更新: system_prompt_loaded = {system_prompt_loaded}")
+            session["system_prompt_loaded"] = True
+            log_detail("已添加系統提示和產品資訊到對話歷史中")
+            log_detail(f"系統提示狀態更新: system_prompt_loaded = {session['system_prompt_loaded']}")
         else:
-            logging.info("系統提示已加載，無需重新加載")
+            log_detail("系統提示已加載，無需重新加載")
 
         # 添加用戶消息到對話歷史
-        conversation.append({"role": "user", "content": user_input})
-        logging.info(f"添加用戶消息到對話歷史，當前對話長度: {len(conversation)}")
+        append_message(session, "user", user_input)
+        log_detail(f"添加用戶消息到對話歷史，當前對話長度: {len(conversation)}")
+
+        # 超過 tokens 預算時壓縮較早的對話
+        await compact_conversation(session, state)
+
+        # 依 tokens 帳本在請求前確認大小，避免送出注定失敗的請求
+        max_tokens = fit_request_to_context(session)
+        prompt_tokens = get_prompt_tokens(session)
+        if max_tokens is None:
+            logging.error(f"請求超過模型上下文限制 - 輸入 tokens: {prompt_tokens}")
+            drop_unanswered_message(session, user_input)
+            await session_store.commit(session_id)
+            log_turn(started, "error")
+            yield "抱歉，您的訊息內容過長，請縮短後再試，或點選「清除聊天」重新開始。"
+            return
+        log_detail(f"請求大小 - 輸入 tokens: {prompt_tokens}, max_tokens: {max_tokens}")
 
         # --- 恢復：始終使用包含系統提示的完整對話歷史 ---
         # 創建一個副本以避免修改原始對話歷史
-        messages_to_send = conversation.copy()
+        messages_to_send = build_request_messages(session)
         
         # 確保messages_to_send中system消息只在第一位置 (用於日誌)
         if len(messages_to_send) > 0 and messages_to_send[0]["role"] == "system":
             # 記錄發送的對話長度和第一條消息類型
-            logging.info(f"發送請求 - 對話歷史長度: {len(messages_to_send)}, 第一條消息類型: {messages_to_send[0]['role']}")
-            logging.info(f"前10個字符: {messages_to_send[0]['content'][:10]}...")
+            log_detail(f"發送請求 - 對話歷史長度: {len(messages_to_send)}, 第一條消息類型: {messages_to_send[0]['role']}")
+            log_detail(f"前10個字符: {messages_to_send[0]['content'][:10]}...")
         else:
             # 這種情況理論上不應發生，除非首次請求前就有非系統消息
              logging.warning("警告: 發送請求時對話歷史的第一條消息不是系統提示")
         # --- 恢復結束 ---
 
-        response = openai.ChatCompletion.create(
-            model="gpt-4.1-mini-2025-04-14",
-            messages=messages_to_send
-        )
+        # 相同的對話開頭直接使用快取回應，不呼叫 API
+        cache_key = None
+        cached_reply = None
+        if is_cacheable_conversation(messages_to_send):
+            cache_key = ResponseCache.make_key(session["catalog"]["version"], OPENAI_MODEL, messages_to_send)
+            cached_reply = response_cache.get(cache_key)
+
+        reply = ""
+        usage = None
+        first_token_ms = None
+        if cached_reply is not None:
+            reply = cached_reply
+            log_detail(f"使用快取回應 - 快取統計: {response_cache.stats()}")
+            yield reply
+        else:
+            async for chunk in get_dispatcher().stream(
+                estimated_tokens=prompt_tokens + max_tokens,
+                model=OPENAI_MODEL,
+                messages=messages_to_send,
+                max_tokens=max_tokens
+            ):
+                # 最後一個區塊只帶有 usage，沒有 choices
+                if chunk.get("usage"):
+                    usage = chunk["usage"]
+                if chunk.get("choices"):
+                    delta = chunk["choices"][0].get("delta", {}).get("content")
+                    if delta:
+                        if first_token_ms is None:
+                            first_token_ms = round((time.perf_counter() - started) * 1000, 1)
+                        reply += delta
+                        yield reply
+            if cache_key and reply and len(reply) <= RESPONSE_CACHE_MAX_CHARS:
+                response_cache.put(cache_key, reply)
 
         # 計算本次請求的成本
-        current_cost, total_cost = calculate_api_cost(response, is_new_conversation)
+        if cached_reply is not None:
+            current_cost, total_cost = 0.0, session["api_cost"]
+        elif usage is None:
+            logging.warning("串流回應未包含 usage 資訊，本次成本以 0 計")
+            current_cost, total_cost = 0.0, session["api_cost"]
+        else:
+            current_cost, total_cost = calculate_api_cost(usage, session, is_new_conversation)
+            step = FLOW_STEPS[state.get("step", 0)]
+            PROMPT_TOKENS.inc(usage["prompt_tokens"], step=step, model=OPENAI_MODEL)
+            CACHED_PROMPT_TOKENS.inc((usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0, step=step, model=OPENAI_MODEL)
+            COMPLETION_TOKENS.inc(usage["completion_tokens"], step=step, model=OPENAI_MODEL)
+            API_COST.inc(current_cost, model=OPENAI_MODEL)
+            log_detail(f"tokens 帳本 - 預估輸入: {prompt_tokens}, 實際輸入: {usage['prompt_tokens']}")
         
-        reply = response.choices[0].message.content
-        conversation.append({"role": "assistant", "content": reply})
+        append_message(session, "assistant", reply)
+        session_store.trim(session)
+        advance_step(state, reply)
+        log_detail(f"目前步驟: {FLOW_STEPS[state['step']]}")
 
         # 添加成本信息到回覆中
         cost_info = f"\n\n[本次請求成本: ${current_cost:.4f} | 累計成本: ${total_cost:.4f}]"
         reply += cost_info
 
-        # 更新當前分類（如果在回覆中提到）
-        for category in product_categories.keys():
-            if category in reply:
-                state["current_category"] = category
-                break
+        # 更新當前分類及推薦的產品（如果在回覆中提到）
+        product_ids = record_mentions(reply, state, session["catalog"])
 
         state["recommendations"] = reply
         state["email_content"] = reply
+        await session_store.commit(session_id)
+
+        log_detail("成功生成推薦回應")
+        log_turn(
+            started, "cache" if cached_reply is not None else "model",
+            first_token_ms=first_token_ms,
+            prompt_tokens=usage["prompt_tokens"] if usage else None,
+            completion_tokens=usage["completion_tokens"] if usage else None,
+            cost=round(current_cost, 6),
+            recommended_products=product_ids or None
+        )
+        log_detail(f"查詢後狀態 - 會話: {session_id}, system_prompt_loaded: {session['system_prompt_loaded']}, 對話長度: {len(conversation)}")
+        yield reply
 
-        # 創建對話歷史 - 跳過第一條系統消息
-        conversation_history = []
-        for i in range(1, len(conversation) - 1, 2):
-            if i+1 < len(conversation):
-                conversation_history.append((conversation[i]['content'], conversation[i+1]['content']))
-
-        logging.info("成功生成推薦回應")
-        logging.info(f"查詢後狀態 - system_prompt_loaded: {system_prompt_loaded}, 對話長度: {len(conversation)}")
-        return conversation_history, state
+    except OpenAIUnavailableError as e:
+        logging.warning(f"OpenAI 暫時無法使用，改用降級回覆: {str(e)}")
+        drop_unanswered_message(session, user_input)
+        await session_store.commit(session_id)
+        log_turn(started, "degraded")
+        yield render_degraded_reply(user_input, state, session["conversation"], session["catalog"])
 
     except Exception as e:
         logging.error(f"生成推薦時發生錯誤: {str(e)}")
-        error_message = "抱歉，系統暫時無法處理您的請求，請稍後再試。"
-        return [(user_input, error_message)], state
+        drop_unanswered_message(session, user_input)
+        await session_store.commit(session_id)
+        log_turn(started, "error")
+        yield "抱歉，系統暫時無法處理您的請求，請稍後再試。"
 
-def send_email(to_email, subject, body):
-    try:
-        sender_email = os.getenv("EMAIL_SENDER")
-        sender_password = os.getenv("EMAIL_PASSWORD")
-        
-        # 添加環境變數檢查
-        if not sender_email:
-            logging.error("EMAIL_SENDER 環境變數未設置")
-            return "郵件設定錯誤：寄件者郵箱未設置"
-        if not sender_password:
-            logging.error("EMAIL_PASSWORD 環境變數未設置")
-            return "郵件設定錯誤：寄件者密碼未設置"
-            
-        logging.info(f"嘗試使用郵箱帳號: {sender_email}")
-        
-        smtp_server = "smtp.gmail.com"
-        smtp_port = 587
+class SingleFlight:
+    """每個會話同時只處理一輪：進行中的相同輸入（例如連按兩次 Enter）共用同一個結果，不同的輸入依序排隊
 
-        disclaimer = "\n\n免責聲明: 本系統僅為參考，所有產品資訊請以實際產品網頁為主，詳細信息請查閱相關網站。"
-
-        msg = MIMEMultipart()
-        msg["From"] = sender_email
-        msg["To"] = to_email
-        msg["Subject"] = subject
-
-        body_with_disclaimer = body + disclaimer
-        msg.attach(MIMEText(body_with_disclaimer, "plain"))
+    只在單一進程內生效；多個 worker 時由會話存儲的版本號處理跨進程的更新。
+    """
 
+    def __init__(self):
+        self._locks = {}  # 會話 ID -> [asyncio.Lock, 使用中的回合數]
+        self._inflight = {}  # (會話 ID, 正規化後的輸入) -> asyncio.Future
+
+    def __len__(self):
+        return len(self._inflight)
+
+    def pending(self, session_id, user_input):
+        """相同的輸入是否正在處理或排隊中"""
+        return (session_id, ResponseCache.normalize(user_input)) in self._inflight
+
+    async def run(self, session_id, user_input, turn):
+        """turn() 回傳產生回覆的非同步產生器；重複的輸入只取得最後的完整回覆"""
+        key = (session_id, ResponseCache.normalize(user_input))
+        future = self._inflight.get(key)
+        if future is not None:
+            TURNS_COALESCED.inc()
+            log_detail(f"相同的輸入正在處理中，共用結果 - 會話: {session_id}")
+            yield await asyncio.shield(future)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        entry = self._locks.setdefault(session_id, [asyncio.Lock(), 0])
+        entry[1] += 1
         try:
-            server = smtplib.SMTP(smtp_server, smtp_port)
+            if entry[0].locked():
+                TURNS_QUEUED.inc()
+            async with entry[0]:
+                reply = None
+                async for reply in turn():
+                    yield reply
+                future.set_result(reply)
+        finally:
+            if not future.done():
+                # 處理中斷（例如連線關閉）時，等待中的重複輸入取得錯誤訊息
+                future.set_result("抱歉，系統暫時無法處理您的請求，請稍後再試。")
+            del self._inflight[key]
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[session_id]
+
+
+single_flight = SingleFlight()
+
+def run_turn(user_input, state, email, session_id="default"):
+    """經由 single_flight 處理一輪對話，介面、API 與 query_chatgpt 都由此進入"""
+    return single_flight.run(session_id, user_input, lambda: stream_chatgpt(user_input, state, email, session_id))
+
+def format_cost_display(session):
+    """成本顯示文字，包含目前對話的輸入 tokens"""
+    return f"預估API成本: ${session['api_cost']:.4f} | 對話 tokens: {get_prompt_tokens(session)}"
+
+async def query_chatgpt(user_input, state, email, session_id="default"):
+    """等待完整回覆後回傳 (對話歷史, state)，供不需要串流的呼叫端使用"""
+    reply = ""
+    async for reply in run_turn(user_input, state, email, session_id):
+        pass
+
+    # 創建對話歷史 - 跳過系統消息，最後一輪使用包含成本資訊（或錯誤訊息）的回覆
+    conversation_history = build_chat_history(session_store.get(session_id, refresh=False)["conversation"])
+    if conversation_history and conversation_history[-1][0] == user_input:
+        conversation_history[-1] = (user_input, reply)
+    else:
+        conversation_history.append((user_input, reply))
+    return conversation_history, state
+
+class EmailOutbox:
+    """郵件寄送佇列：由背景執行緒重複使用已登入的 SMTP 連線寄送，失敗時延遲重試，待寄郵件存於磁碟"""
+
+    STATUS_LIMIT = 1000  # 保留查詢狀態的郵件數上限
+
+    def __init__(self, directory, host, port, starttls=True, idle_timeout=60,
+                 max_attempts=5, retry_backoff=5):
+        self.directory = directory
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self.idle_timeout = idle_timeout
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self._pending = []  # (預定寄送時間, 序號, 郵件)
+        self._sequence = 0
+        self._statuses = OrderedDict()
+        self._condition = threading.Condition()
+        self._server = None
+        self._last_used = 0.0
+        self._worker = None
+
+    def __len__(self):
+        with self._condition:
+            return len(self._pending)
+
+    def _job_path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def _persist(self, job):
+        """以暫存檔加 os.replace 寫入，避免重啟時讀到寫到一半的郵件"""
+        path = self._job_path(job["id"])
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _set_status(self, job_id, status):
+        self._statuses[job_id] = status
+        self._statuses.move_to_end(job_id)
+        while len(self._statuses) > self.STATUS_LIMIT:
+            self._statuses.popitem(last=False)
+
+    def _schedule(self, job, due):
+        """呼叫端需持有 self._condition"""
+        self._sequence += 1
+        heapq.heappush(self._pending, (due, self._sequence, job))
+        self._condition.notify()
+
+    def start(self, recover=True):
+        """載入磁碟上尚未寄出的郵件並啟動背景執行緒，重複呼叫不會重複啟動
+
+        多個 worker 共用郵件目錄時只由父進程恢復待寄郵件（recover=False），避免重複寄送。
+        """
+        with self._condition:
+            if self._worker is not None:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            restored = 0
+            for name in sorted(os.listdir(self.directory)) if recover else []:
+                if not name.endswith(".json"):
+                    continue
+                try:
+                    with open(os.path.join(self.directory, name), encoding="utf-8") as f:
+                        job = json.load(f)
+                    self._set_status(job["id"], "排隊中")
+                    self._schedule(job, time.time())
+                    restored += 1
+                except Exception as e:
+                    logging.error(f"讀取待寄郵件 {name} 時發生錯誤: {str(e)}")
+            self._worker = threading.Thread(target=self._run, name="email-outbox", daemon=True)
+            self._worker.start()
+        logging.info(f"郵件寄送佇列已啟動，恢復 {restored} 封待寄郵件")
+
+    def submit(self, to_email, subject, body, product_ids=None):
+        """將郵件存入磁碟並排入佇列，立即回傳追蹤編號；product_ids 為郵件中推薦的產品，供統計使用"""
+        self.start(recover=not SESSION_SHARED)
+        job = {
+            "id": uuid.uuid4().hex[:12],
+            "to": to_email,
+            "subject": subject,
+            "body": body,
+            "product_ids": list(product_ids or []),
+            "attempts": 0,
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+        }
+        with self._condition:
+            self._persist(job)
+            self._set_status(job["id"], "排隊中")
+            self._schedule(job, time.time())
+        logging.info(f"郵件已排入佇列 - 追蹤編號: {job['id']}, 收件者: {to_email}, 推薦產品: {job['product_ids']}")
+        return job["id"]
+
+    def status(self, job_id):
+        with self._condition:
+            status = self._statuses.get(job_id)
+        if status is None and re.fullmatch(r'[0-9a-f]{12}', job_id):
+            # 由其他 worker 排入的郵件，只能從磁碟判斷是否仍待寄或已失敗
+            if os.path.exists(self._job_path(job_id)):
+                return "處理中"
+            if os.path.exists(self._job_path(job_id) + ".failed"):
+                return "寄送失敗"
+        return status
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=30)
+        if self.starttls:
             server.starttls()
+        sender_password = os.getenv("EMAIL_PASSWORD")
+        if sender_password:
             logging.info("正在嘗試登入 SMTP 伺服器...")
-            server.login(sender_email, sender_password)
+            server.login(os.getenv("EMAIL_SENDER"), sender_password)
             logging.info("SMTP 伺服器登入成功")
-            server.sendmail(sender_email, to_email, msg.as_string())
-            server.quit()
-            logging.info(f"成功發送郵件至 {to_email}")
-            return "郵件已成功發送"
-        except smtplib.SMTPAuthenticationError as e:
-            logging.error(f"SMTP 認證錯誤: {str(e)}")
-            return f"郵件發送失敗: SMTP 認證錯誤，請檢查郵箱設定"
-        except Exception as e:
-            logging.error(f"SMTP 錯誤: {str(e)}")
-            return f"郵件發送失敗: {str(e)}"
-            
+        return server
+
+    def _close(self):
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except Exception:
+            pass
+        self._server = None
+        logging.info("SMTP 連線已關閉")
+
+    def _send(self, job):
+        """使用既有連線寄送；伺服器已斷線時重新連線再寄一次"""
+        sender_email = os.getenv("EMAIL_SENDER")
+        msg = MIMEMultipart()
+        msg["From"] = sender_email
+        msg["To"] = job["to"]
+        msg["Subject"] = job["subject"]
+        msg.attach(MIMEText(job["body"] + EMAIL_DISCLAIMER, "plain"))
+
+        for reconnect in (False, True):
+            if self._server is None:
+                self._server = self._connect()
+            try:
+                self._server.sendmail(sender_email, job["to"], msg.as_string())
+                self._last_used = time.monotonic()
+                return
+            except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                self._server = None
+                if reconnect:
+                    raise
+                logging.info(f"SMTP 連線已中斷，重新連線: {str(e)}")
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    now = time.time()
+                    if self._pending and self._pending[0][0] <= now:
+                        _, _, job = heapq.heappop(self._pending)
+                        break
+                    timeout = self._pending[0][0] - now if self._pending else None
+                    if self._server is not None:
+                        idle_left = self.idle_timeout - (time.monotonic() - self._last_used)
+                        if idle_left <= 0:
+                            self._close()
+                        else:
+                            timeout = idle_left if timeout is None else min(timeout, idle_left)
+                    self._condition.wait(timeout)
+                self._set_status(job["id"], "寄送中")
+
+            try:
+                self._send(job)
+            except Exception as e:
+                self._close()
+                with self._condition:
+                    self._retry_or_fail(job, e)
+                continue
+
+            with self._condition:
+                self._set_status(job["id"], "已寄出")
+                try:
+                    os.remove(self._job_path(job["id"]))
+                except OSError as e:
+                    logging.error(f"刪除已寄出郵件檔案時發生錯誤: {str(e)}")
+            logging.info(f"成功發送郵件至 {job['to']} - 追蹤編號: {job['id']}")
+
+    def _retry_or_fail(self, job, error):
+        """呼叫端需持有 self._condition"""
+        job["attempts"] += 1
+        if job["attempts"] >= self.max_attempts or isinstance(error, smtplib.SMTPAuthenticationError):
+            logging.error(f"郵件寄送失敗，不再重試 - 追蹤編號: {job['id']}, 錯誤: {str(error)}")
+            self._set_status(job["id"], f"寄送失敗: {str(error)}")
+            try:
+                os.replace(self._job_path(job["id"]), self._job_path(job["id"]) + ".failed")
+            except OSError as e:
+                logging.error(f"保存寄送失敗郵件時發生錯誤: {str(e)}")
+            return
+        delay = self.retry_backoff * 2 ** (job["attempts"] - 1)
+        logging.error(f"郵件寄送錯誤，{delay:g} 秒後重試（第 {job['attempts']} 次）- 追蹤編號: {job['id']}, 錯誤: {str(error)}")
+        self._persist(job)
+        self._set_status(job["id"], f"等待重試（第 {job['attempts']} 次失敗）")
+        self._schedule(job, time.time() + delay)
+
+email_outbox = EmailOutbox(
+    EMAIL_OUTBOX_DIR, SMTP_HOST, SMTP_PORT, starttls=SMTP_STARTTLS, idle_timeout=SMTP_IDLE_TIMEOUT,
+    max_attempts=EMAIL_MAX_ATTEMPTS, retry_backoff=EMAIL_RETRY_BACKOFF
+)
+
+def send_email(to_email, subject, body, product_ids=None):
+    """將郵件排入寄送佇列後立即返回，實際寄送由背景執行緒完成"""
+    try:
+        # 添加環境變數檢查
+        if not os.getenv("EMAIL_SENDER"):
+            logging.error("EMAIL_SENDER 環境變數未設置")
+            return "郵件設定錯誤：寄件者郵箱未設置"
+
+        job_id = email_outbox.submit(to_email, subject, body, product_ids)
+        return f"郵件已排入寄送佇列，追蹤編號: {job_id}"
+
     except Exception as e:
         logging.error(f"發送郵件時發生錯誤: {str(e)}")
         return f"郵件發送失敗: {str(e)}"
 
-def interact(user_input, state, email):
+async def interact(user_input, state, email):
     # 此函數不再需要修改，直接使用原有的 query_chatgpt
-    chat_history, state = query_chatgpt(user_input, state, email)
+    chat_history, state = await query_chatgpt(user_input, state, email)
     return chat_history, state, ""
     
-def gradio_interface(user_input, email, state):
+async def gradio_interface(user_input, email, state):
     if state is None:
-        state = {
-            "step": 0,
-            "top_matches": None,
-            "products_info": None,
-            "recommendations": "",
-            "email_content": "",
-            "chat_history": [],
-            "current_category": None
-        }
-    return interact(user_input, state, email)
+        state = new_flow_state()
+    return await interact(user_input, state, email)
 
 # Gradio Blocks UI
 with gr.Blocks(
@@ -984,50 +3028,66 @@ with gr.Blocks(
         )
     
     # 修改處理輸入的函數，使用戶訊息立即顯示
-    def process_input(user_input, chatbot, state, email):
+    def process_input(user_input, chatbot, state, email, request: gr.Request):
         if not user_input.strip():
             return chatbot, state, "", ""  # 修改返回值，清空輸入框
         
+        # 相同的訊息仍在處理中（重複送出）時不再顯示一次，回覆會共用進行中的結果；
+        # 事件送出後到開始處理前，single_flight 尚未登記，以最後一則仍在等待回覆的訊息判斷
+        session_id = request.session_hash if request else "default"
+        last_pending = chatbot and chatbot[-1][1] is None and chatbot[-1][0] \
+            and ResponseCache.normalize(chatbot[-1][0]) == ResponseCache.normalize(user_input)
+        if single_flight.pending(session_id, user_input) or last_pending:
+            return chatbot, state, "", user_input
+
         # 先將用戶訊息添加到聊天視窗
         chatbot = chatbot + [(user_input, None)]
         
         # 返回更新後的界面，使用戶訊息立即顯示，並清空輸入框
         return chatbot, state, "", user_input
         
-    # 添加一個新函數來處理 API 響應
-    def process_response(chatbot, state, last_user_input, email):
+    # 添加一個新函數來處理 API 響應（串流顯示）
+    async def process_response(chatbot, state, last_user_input, email, request: gr.Request):
         if not chatbot or not last_user_input:
-            return chatbot, state, "", f"預估API成本: $0.0000"
+            yield chatbot, state, "", f"預估API成本: $0.0000", email
+            return
             
         loading_indicator.visible = True
+        session_id = request.session_hash if request else "default"
+        session = await session_store.fetch(session_id)
+        # 流程狀態以會話存儲為準：多個 worker 時，gr.State 只保存在處理上一個事件的 worker 中
+        if session_store.shared:
+            state = session["state"]
+        cost_display_text = format_cost_display(session)
         
         try:
-            chat_history, updated_state = query_chatgpt(last_user_input, state, email)
-            
-            # 更新成本顯示
-            cost_display_text = f"預估API成本: ${api_cost:.4f}"
-            
-            # 從 chat_history 中獲取 AI 回應
+            last_update = 0.0
             ai_response = "無法獲取回應"
-            if isinstance(chat_history, list) and len(chat_history) > 0:
-                latest_response = chat_history[-1]
-                if isinstance(latest_response, tuple) and len(latest_response) > 1:
-                    ai_response = latest_response[1]
+            rows = None
+            async for ai_response in run_turn(last_user_input, state, email, session_id):
+                # 取得第一個區塊時排在前面的回合已完成，以會話歷史更新一次快照中的較早回合
+                if rows is None:
+                    rows = merge_chat_history(chatbot, session_store.get(session_id, refresh=False)["conversation"], last_user_input, ai_response)[:-1]
+                # 更新聊天窗口中最後一條消息的回應部分，限制更新頻率以減少傳輸量
+                chatbot = rows + [(last_user_input, ai_response)]
+                now = time.monotonic()
+                if now - last_update >= STREAM_UPDATE_INTERVAL:
+                    last_update = now
+                    yield chatbot, state, "", cost_display_text, email
             
-            # 更新聊天窗口中最後一條消息的回應部分
-            if len(chatbot) > 0:
-                chatbot[-1] = (chatbot[-1][0], ai_response)
+            # 更新成本顯示
+            cost_display_text = format_cost_display(session_store.get(session_id, refresh=False))
             
         except Exception as e:
             logging.error(f"處理回應時發生錯誤: {str(e)}")
-            if len(chatbot) > 0:
-                chatbot[-1] = (chatbot[-1][0], "抱歉，處理您的請求時發生錯誤，請重試。")
-            cost_display_text = f"預估API成本: ${api_cost:.4f}"
+            ai_response = "抱歉，處理您的請求時發生錯誤，請重試。"
+        # 最終結果以會話歷史重建，不沿用事件觸發時的快照
+        chatbot = merge_chat_history(chatbot, session_store.get(session_id, refresh=False)["conversation"], last_user_input, ai_response)
         
         loading_indicator.visible = False
         
-        # 返回更新後的界面並清空輸入框
-        return chatbot, updated_state, "", cost_display_text
+        # 返回更新後的界面並清空輸入框，對話中收集到的電子郵件填入郵件欄位
+        yield chatbot, state, "", cost_display_text, state.get("email") or email
     
     # 修改事件處理，添加成本顯示的更新
     user_input.submit(
@@ -1037,33 +3097,30 @@ with gr.Blocks(
     ).then(
         fn=process_response,
         inputs=[chatbot, state, user_input, email],
-        outputs=[chatbot, state, user_input, cost_display]
+        outputs=[chatbot, state, user_input, cost_display, email]
     )
 
-    def handle_send_email(email, state):
+    def handle_send_email(email, state, request: gr.Request):
+        if session_store.shared and request:
+            state = session_store.get(request.session_hash)["state"]
+        email = email or state.get("email")
         if not email:
             return [("Assistant", "請輸入有效的電子郵件地址")]
         
         if "email_content" not in state:
             return [("Assistant", "無法獲取推薦內容，請先進行推薦。")]
         
-        subject = "智慧照顧產品推薦結果"
-        result = send_email(email, subject, state["email_content"])
+        result = send_email(email, EMAIL_SUBJECT, state["email_content"], state.get("recommended_products"))
         return [("Assistant", result)]
 
-    def clear_chat(state):
-        global conversation, api_cost, system_prompt_loaded
-        conversation = []
-        system_prompt_loaded = False  # 重置系統提示加載狀態
-        state = {
-            "step": 0,
-            "top_matches": None,
-            "products_info": None,
-            "recommendations": "",
-            "email_content": "",
-            "chat_history": [],
-            "current_category": None
-        }
+    async def clear_chat(state, request: gr.Request):
+        # 重置此會話的對話歷史和系統提示加載狀態
+        session_id = request.session_hash if request else "default"
+        await session_store.fetch(session_id)
+        session = session_store.reset(session_id)
+        state = session["state"] = new_flow_state()
+        # 等待寫入完成，下一輪由其他 worker 處理時不會讀到清除前的對話
+        await session_store.commit(session_id)
         # 不重置 api_cost，因為我們要保留總計費用
         # 顯示歡迎消息
         welcome_message = "您好！我是智慧照顧產品推薦專家，請問您在尋找哪方面的協助或產品呢？"
@@ -1086,9 +3143,110 @@ with gr.Blocks(
         welcome_message = "您好！我是智慧照顧產品推薦專家，請問您在尋找哪方面的協助或產品呢？"
         return [(None, welcome_message)]
 
+# 對話狀態已依會話隔離，非同步處理函數可在單一事件循環中同時處理多個請求
+demo.queue(concurrency_count=GRADIO_CONCURRENCY)
+
+# FastAPI 應用：/metrics 輸出監控指標，其餘路徑交給 Gradio 介面
+web_app = FastAPI()
+
+@web_app.get("/metrics")
+def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+# JSON API：供資訊站、LINE 機器人等整合直接呼叫，會話狀態保存在 session_store
+class MessageRequest(BaseModel):
+    message: str
+    email: Optional[str] = None
+
+class EmailRequest(BaseModel):
+    email: Optional[str] = None
+
+async def get_api_session(session_id):
+    if not await session_store.contains(session_id):
+        raise HTTPException(status_code=404, detail="找不到此會話，請重新建立")
+    return await session_store.fetch(session_id)
+
+def render_api_session(session_id, session, reply=None):
+    state = session["state"]
+    payload = {
+        "session_id": session_id,
+        "step": state["step"],
+        "step_name": FLOW_STEPS[state["step"]],
+        "current_category": state["current_category"],
+        "recommended_products": state["recommended_products"],
+        "email": state["email"] or None,
+        "api_cost": round(session["api_cost"], 6),
+        "conversation_tokens": get_prompt_tokens(session),
+    }
+    if reply is not None:
+        payload["reply"] = reply
+    return payload
+
+@web_app.post("/api/sessions")
+async def api_create_session():
+    session_id = uuid.uuid4().hex
+    session = await session_store.fetch(session_id)
+    await session_store.commit(session_id)
+    return render_api_session(session_id, session, WELCOME_MESSAGE)
+
+@web_app.get("/api/sessions/{session_id}")
+async def api_get_session(session_id: str):
+    session = await get_api_session(session_id)
+    payload = render_api_session(session_id, session)
+    payload["history"] = [
+        {"role": m["role"], "content": m["content"]}
+        for m in session["conversation"] if m["role"] != "system"
+    ]
+    return payload
+
+@web_app.post("/api/sessions/{session_id}/messages")
+async def api_send_message(session_id: str, body: MessageRequest):
+    """送出用戶消息並回傳完整回覆；會話不存在時以此 ID 建立新會話"""
+    if not body.message.strip():
+        raise HTTPException(status_code=400, detail="訊息不可為空白")
+    state = (await session_store.fetch(session_id))["state"]
+    reply = ""
+    async for reply in run_turn(body.message, state, body.email or state["email"], session_id):
+        pass
+    session = session_store.get(session_id, refresh=False)
+    # 回覆本文不含成本資訊，成本另以欄位提供
+    conversation = session["conversation"]
+    if conversation and conversation[-1]["role"] == "assistant" and reply.startswith(conversation[-1]["content"]):
+        reply = conversation[-1]["content"]
+    if body.email:
+        state["email"] = body.email
+    return render_api_session(session_id, session, reply)
+
+@web_app.post("/api/sessions/{session_id}/email")
+async def api_send_email(session_id: str, body: EmailRequest):
+    """將目前的推薦結果排入寄送佇列，回傳追蹤編號"""
+    state = (await get_api_session(session_id))["state"]
+    email = body.email or state["email"]
+    if not email or not EMAIL_PATTERN.fullmatch(email):
+        raise HTTPException(status_code=400, detail="請輸入有效的電子郵件地址")
+    if not state["email_content"]:
+        raise HTTPException(status_code=409, detail="無法獲取推薦內容，請先進行推薦。")
+    if not os.getenv("EMAIL_SENDER"):
+        raise HTTPException(status_code=503, detail="郵件設定錯誤：寄件者郵箱未設置")
+    tracking_id = email_outbox.submit(email, EMAIL_SUBJECT, state["email_content"], state["recommended_products"])
+    return {"tracking_id": tracking_id, "status": email_outbox.status(tracking_id)}
+
+@web_app.get("/api/emails/{tracking_id}")
+async def api_email_status(tracking_id: str):
+    status = email_outbox.status(tracking_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="找不到此追蹤編號")
+    return {"tracking_id": tracking_id, "status": status}
+
+@web_app.on_event("startup")
+async def start_worker_background_tasks():
+    # 多 worker 時每個 worker 各自監看產品目錄（單進程由 __main__ 啟動）
+    if WEB_CONCURRENCY > 1:
+        start_catalog_watcher()
+
+web_app = gr.mount_gradio_app(web_app, demo, path="/")
+
 if __name__ == "__main__":
-    demo.launch(
-        server_name="0.0.0.0",
-        server_port=int(os.getenv("PORT", 7860)),
-        share=True
-    )
+    start_catalog_watcher()
+    email_outbox.start()
+    uvicorn.run(web_app, host="0.0.0.0", port=int(os.getenv("PORT", 7860)), timeout_keep_alive=HTTP_KEEP_ALIVE)
@@ -0,0 +1,195 @@
+"""批次推薦：讀取 CSV / JSONL 的照顧需求，逐筆以單次提示詞產生推薦，結果與每筆成本寫入 JSONL
+
+python batch.py needs.csv --output results.jsonl --csv-output results.csv
+中斷後以相同指令重新執行，已完成的列會略過，失敗的列會重試。
+"""
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import sys
+import time
+
+import app
+
+# 批次模式沒有來回對話，要求模型略過確認步驟直接推薦
+BATCH_INSTRUCTION = """這是批次推薦：客戶無法回答追問，請不要詢問任何問題，也不要進行步驟一至步驟三的確認。
+請直接依據下方的客戶需求，從產品資訊中挑選最符合的至少三項產品，依步驟四的格式完整列出，最後以一段話說明推薦理由。"""
+
+NEEDS_COLUMNS = ("needs", "需求", "照顧需求")
+
+
+def read_rows(path, column=None, id_column=None):
+    """讀取需求檔，回傳 [(列編號, 需求, 原始資料)]；未指定編號欄位時以列序號為編號"""
+    if path.endswith(".jsonl"):
+        with open(path, encoding="utf-8") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+    else:
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            records = list(csv.DictReader(f))
+    if not records:
+        return []
+    column = column or next((c for c in NEEDS_COLUMNS if c in records[0]), None)
+    if column is None:
+        raise ValueError(f"找不到需求欄位，請以 --column 指定（可用欄位: {', '.join(records[0].keys())}）")
+    rows = []
+    for index, record in enumerate(records, 1):
+        row_id = str(record.get(id_column) if id_column else index)
+        rows.append((row_id, str(record.get(column) or "").strip(), record))
+    return rows
+
+
+def load_checkpoint(path):
+    """讀取既有輸出，回傳已完成（成功或略過）的列編號"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # 中斷時寫到一半的最後一行
+            if result.get("status") in ("ok", "skipped"):
+                done.add(result["id"])
+    return done
+
+
+def build_messages(needs):
+    """與對話相同的系統提示，加上批次指示與客戶需求
+
+    共用前綴布局下檢索到的產品放在批次指示之後，讓所有列共用同一段可快取的前綴。
+    """
+    active_catalog = app.catalog
+    if app.PROMPT_CACHE_LAYOUT:
+        prefix, _ = app.build_cache_prefix(active_catalog)
+        messages = [{"role": "system", "content": prefix}, {"role": "system", "content": BATCH_INSTRUCTION}]
+        focus = app.build_focus_message({}, [], needs, active_catalog)
+        if focus:
+            messages.append({"role": "system", "content": focus})
+        messages.append({"role": "user", "content": needs})
+        product_count = focus.count("產品名稱：") if focus else app.get_prompt_bundle(None, active_catalog)["product_count"]
+        return messages, product_count
+    system_prompt, product_count, _ = app.build_system_prompt({}, [], needs, active_catalog)
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "system", "content": BATCH_INSTRUCTION},
+        {"role": "user", "content": needs},
+    ]
+    return messages, product_count
+
+
+async def recommend(row_id, needs, retries):
+    """產生單筆推薦
+
+    暫時性錯誤已由調度器重試；只有上游持續無法使用（OpenAIUnavailableError）時，等斷路器冷卻後整列重試。
+    """
+    result = {"id": row_id, "needs": needs}
+    if not needs:
+        return {**result, "status": "skipped", "error": "需求為空白"}
+    messages, product_count = build_messages(needs)
+    estimated_tokens = app.estimate_prompt_tokens(messages) + app.MAX_COMPLETION_TOKENS
+    started = time.perf_counter()
+    for attempt in range(retries + 1):
+        try:
+            response = await app.get_dispatcher().create(
+                estimated_tokens=estimated_tokens,
+                model=app.OPENAI_MODEL,
+                messages=messages,
+                max_tokens=app.MAX_COMPLETION_TOKENS
+            )
+            usage = response["usage"]
+            cost, _ = app.calculate_api_cost(usage, {"api_cost": 0.0})
+            return {
+                **result,
+                "status": "ok",
+                "reply": response["choices"][0]["message"]["content"],
+                "products_in_prompt": product_count,
+                "prompt_tokens": usage["prompt_tokens"],
+                "cached_tokens": (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0,
+                "completion_tokens": usage["completion_tokens"],
+                "cost": round(cost, 6),
+                "duration_seconds": round(time.perf_counter() - started, 3),
+            }
+        except app.OpenAIUnavailableError as e:
+            logging.error(f"批次推薦第 {row_id} 列失敗（第 {attempt + 1} 次）: {str(e)}")
+            if attempt == retries:
+                return {**result, "status": "error", "error": str(e)}
+            await asyncio.sleep(app.get_dispatcher().breaker.remaining() or app.OPENAI_RETRY_MAX_DELAY)
+        except Exception as e:
+            # 請求本身的錯誤（例如 400、401）重試也不會成功
+            logging.error(f"批次推薦第 {row_id} 列失敗: {str(e)}")
+            return {**result, "status": "error", "error": str(e)}
+
+
+async def run_batch(rows, output_path, concurrency, retries):
+    semaphore = asyncio.Semaphore(concurrency)
+    totals = {"ok": 0, "error": 0, "skipped": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "cost": 0.0}
+
+    with open(output_path, "a", encoding="utf-8") as output:
+        async def worker(row_id, needs):
+            async with semaphore:
+                result = await recommend(row_id, needs, retries)
+            # 每完成一列立即寫入，作為中斷後續跑的檢查點
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            output.flush()
+            totals[result["status"]] += 1
+            totals["prompt_tokens"] += result.get("prompt_tokens", 0)
+            totals["cached_tokens"] += result.get("cached_tokens", 0)
+            totals["completion_tokens"] += result.get("completion_tokens", 0)
+            totals["cost"] += result.get("cost", 0.0)
+            done = totals["ok"] + totals["error"] + totals["skipped"]
+            print(f"[{done}/{len(rows)}] 第 {row_id} 列: {result['status']}", file=sys.stderr)
+
+        await asyncio.gather(*[worker(row_id, needs) for row_id, needs, _ in rows])
+    totals["cost"] = round(totals["cost"], 6)
+    return totals
+
+
+def export_csv(output_path, csv_path):
+    """將 JSONL 結果（每列取最後一次結果）轉為 CSV，方便以試算表開啟"""
+    latest = {}
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            latest[result["id"]] = result
+    fields = ["id", "needs", "status", "reply", "prompt_tokens", "cached_tokens", "completion_tokens", "cost", "error"]
+    with open(csv_path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(latest.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批次產生照顧產品推薦")
+    parser.add_argument("input", help="需求檔（.csv 或 .jsonl）")
+    parser.add_argument("--output", default="batch_results.jsonl", help="結果與檢查點檔（JSONL）")
+    parser.add_argument("--csv-output", help="完成後另存為 CSV")
+    parser.add_argument("--column", help="需求欄位名稱，預設自動尋找 needs / 需求 / 照顧需求")
+    parser.add_argument("--id-column", help="列編號欄位名稱，預設使用列序號")
+    parser.add_argument("--concurrency", type=int, default=10, help="同時處理的列數（另受 OPENAI_MAX_CONCURRENCY 及 RPM/TPM 限制）")
+    parser.add_argument("--retries", type=int, default=2, help="OpenAI 持續無法使用時，每列在斷路器冷卻後的重試次數")
+    parser.add_argument("--limit", type=int, help="只處理前 N 筆尚未完成的列")
+    args = parser.parse_args()
+
+    rows = read_rows(args.input, args.column, args.id_column)
+    done = load_checkpoint(args.output)
+    pending = [row for row in rows if row[0] not in done]
+    print(f"共 {len(rows)} 列，已完成 {len(rows) - len(pending)} 列", file=sys.stderr)
+    if args.limit:
+        pending = pending[:args.limit]
+
+    totals = asyncio.run(run_batch(pending, args.output, args.concurrency, args.retries))
+    if args.csv_output:
+        export_csv(args.output, args.csv_output)
+    print(json.dumps(totals, ensure_ascii=False))
+    sys.exit(1 if totals["error"] else 0)
+
+
+if __name__ == "__main__":
+    main()
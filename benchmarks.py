@@ -0,0 +1,150 @@
+"""啟動與每輪熱點路徑的微基準測試，以 GPTdata0325.xlsx 的欄位產生 100 / 1萬 / 10萬列的合成產品目錄，結果以 JSON 輸出
+
+python benchmarks.py --output bench.json
+python benchmarks.py --sizes 100,10000 --repeat 5 --filter prompt
+"""
+import argparse
+import json
+import logging
+import os
+import pickle
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import pandas as pd
+
+import app
+
+SAMPLE_QUERY = "家中長輩晚上常跌倒，想找不用穿戴、能自動偵測並通知家人的設備"
+
+
+def make_synthetic_catalog(size, directory, seed=0):
+    """從原始目錄抽樣產生指定列數的 Excel 檔，產品名稱加上編號以保持唯一"""
+    path = os.path.join(directory, f"catalog-{size}.xlsx")
+    if os.path.exists(path):
+        return path
+    base = pd.read_excel(app.CATALOG_FILE)
+    df = base.sample(n=size, replace=True, random_state=seed).reset_index(drop=True)
+    df["產品名稱"] = [f"{name}-{i}" for i, name in enumerate(df["產品名稱"])]
+    df.to_excel(path, index=False)
+    return path
+
+
+def measure(func, repeat):
+    """執行 repeat 次並回傳每次的耗時（毫秒）與最後一次的結果"""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings, result
+
+
+def summarize(name, size, timings):
+    return {
+        "name": name,
+        "rows": size,
+        "repeat": len(timings),
+        "min_ms": round(min(timings), 3),
+        "median_ms": round(statistics.median(timings), 3),
+        "mean_ms": round(statistics.fmean(timings), 3),
+    }
+
+
+def run_size(size, path, repeat, selected):
+    """依啟動時的順序逐一測量，後面的步驟使用前一步驟的結果"""
+    results = []
+
+    def bench(name, func, times=repeat):
+        if not selected(name):
+            return func()
+        timings, result = measure(func, times)
+        results.append(summarize(name, size, timings))
+        return result
+
+    # 啟動：讀取 Excel 到建立提示詞組合及檢索索引
+    df = bench("load_excel_data", lambda: app.load_excel_data(path), times=1)
+    products = bench("build_products", lambda: app.build_products(df))
+    categories = bench("group_products", lambda: app.group_products(products))
+    bundles = bench("build_prompt_bundles", lambda: app.build_prompt_bundles(categories, "bench"))
+    index = bench("build_product_index", lambda: app.build_product_index(categories))
+    matcher = bench("build_catalog_matcher", lambda: app.build_catalog_matcher(products))
+    active_catalog = app.assemble_catalog(
+        "bench", products, categories, bundles, index, matcher,
+        app.count_tokens(app.base_system_prompt), bundles["all"]["products_tokens"]
+    )
+    snapshot = bench("snapshot_dump", lambda: pickle.dumps(app.catalog_to_snapshot(active_catalog), protocol=pickle.HIGHEST_PROTOCOL))
+    bench("snapshot_load", lambda: app.catalog_from_snapshot(pickle.loads(snapshot)))
+
+    # 每輪：tokens 計算、系統提示組合、檢索與回覆中的分類及產品比對
+    full_prompt = bundles["all"]["system_prompt"]
+    bench("count_tokens_full_prompt", lambda: app.count_tokens(full_prompt))
+    bench("render_full_prompt", lambda: app.render_prompt_bundle(bundles["product_texts"], bundles["categories_info"]))
+    bench("product_index_search", lambda: index.search(SAMPLE_QUERY, app.RETRIEVAL_TOP_K, min_score=app.RETRIEVAL_MIN_SCORE))
+    conversation = [app.make_message("user", SAMPLE_QUERY)]
+    if app.PROMPT_CACHE_LAYOUT:
+        # 共用前綴布局下每輪只重新組合聚焦消息（分類與檢索到的產品）
+        bench("build_focus_message", lambda: app.build_focus_message({}, conversation, "比較重視自動偵測", active_catalog))
+    else:
+        bench("build_system_prompt", lambda: app.build_system_prompt({}, conversation, "比較重視自動偵測", active_catalog))
+    # 模擬步驟四的推薦回覆：三項產品的完整資訊
+    reply = "以下是為您推薦的產品：\n" + "\n".join(bundles["product_texts"][:3]) + "\n請問以上推薦的產品是否符合您的期待？"
+    bench("record_mentions", lambda: app.record_mentions(reply, app.new_flow_state(), active_catalog))
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="產品目錄載入與提示詞組合的微基準測試")
+    parser.add_argument("--sizes", default="100,10000,100000", help="合成目錄的列數，以逗號分隔")
+    parser.add_argument("--repeat", type=int, default=5, help="每項測量的重複次數（讀取 Excel 只測一次）")
+    parser.add_argument("--filter", default="", help="只執行名稱包含此字串的項目")
+    parser.add_argument("--data-dir", help="合成目錄的存放目錄，預設使用暫存目錄")
+    parser.add_argument("--output", help="結果寫入此檔案，預設輸出到標準輸出")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="bench-catalog-")
+    os.makedirs(data_dir, exist_ok=True)
+
+    results = []
+    for size in [int(s) for s in args.sizes.split(",") if s.strip()]:
+        path = make_synthetic_catalog(size, data_dir)
+        results.extend(run_size(size, path, args.repeat, lambda name: args.filter in name))
+        print(f"完成 {size} 列", file=sys.stderr)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "retrieval_top_k": app.RETRIEVAL_TOP_K,
+            "prompt_cache_layout": app.PROMPT_CACHE_LAYOUT,
+        },
+        "results": results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""壓力測試：啟動本地模擬 OpenAI 伺服器，以多步驟腳本對話同時驅動 app.py 的處理函數，輸出 JSON 報告
+
+python loadtest.py --consultations 200 --concurrency 50 --latency 0.5
+python loadtest.py --baseline last.json --max-regression 0.2   # 效能退步超過 20% 時以代碼 1 結束
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+# 每段對話依序送出的用戶消息，涵蓋本地回覆（招呼、分類選單、電子郵件）與模型回覆的步驟
+DEFAULT_DIALOGUES = [
+    ["你好", "家中長輩晚上常跌倒，想找能偵測的設備", "是的，主要在家裡使用", "比較重視自動偵測，不想穿戴", "正確", "很符合，謝謝", "care@example.com"],
+    ["有哪些分類", "1", "希望能知道長輩夜間有沒有離床", "對，不要穿戴式的", "沒錯", "符合", "family@example.com"],
+    ["我想找可以量血壓並上傳給醫師的設備", "是的", "希望操作簡單，長輩自己就能量", "正確"],
+]
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    # 最近排名法
+    index = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return round(ordered[index], 4)
+
+
+def deep_sizeof(obj, seen=None):
+    """遞迴計算物件佔用的記憶體（略過已計算過的物件）"""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    return size
+
+
+def find_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_mock_server(args):
+    """在子進程啟動 mock_openai.py，避免模擬伺服器與受測程式爭用同一事件循環"""
+    port = find_free_port()
+    command = [
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_openai.py"),
+        "--port", str(port), "--latency", str(args.latency), "--token-delay", str(args.token_delay),
+        "--reply-chars", str(args.reply_chars),
+        "--error-rate", str(args.error_rate), "--rate-limit-rate", str(args.rate_limit_rate),
+        "--slow-rate", str(args.slow_rate), "--slow-latency", str(args.slow_latency),
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return process, f"http://127.0.0.1:{port}/v1"
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("模擬伺服器啟動逾時")
+
+
+async def run_consultation(app, consultation_id, dialogue, semaphore, think_time, turn_latencies):
+    """以 Gradio 事件相同的順序呼叫 process_input 與 process_response 完成一段對話"""
+    request = SimpleNamespace(session_hash=f"loadtest-{consultation_id}")
+    state = app.new_flow_state()
+    chatbot = []
+    email = ""
+    errors = 0
+    degraded = 0
+    async with semaphore:
+        for message in dialogue:
+            started = time.perf_counter()
+            chatbot, state, _, last_user_input = app.process_input(message, chatbot, state, email, request)
+            async for chatbot, state, _, _, email in app.process_response(chatbot, state, last_user_input, email, request):
+                pass
+            turn_latencies.append(time.perf_counter() - started)
+            if chatbot[-1][1].startswith(app.DEGRADED_REPLY_PREFIX):
+                degraded += 1
+            elif chatbot[-1][1].startswith("抱歉"):
+                errors += 1
+            if think_time:
+                await asyncio.sleep(random.uniform(0, think_time))
+    return {"turns": len(dialogue), "errors": errors, "degraded": degraded, "final_step": state.get("step")}
+
+
+async def run_load_test(app, args, dialogues):
+    semaphore = asyncio.Semaphore(args.concurrency)
+    turn_latencies = []
+    prompt_before = app.PROMPT_TOKENS.total()
+    cached_before = app.CACHED_PROMPT_TOKENS.total()
+    completion_before = app.COMPLETION_TOKENS.total()
+    cost_before = app.API_COST.total()
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*[
+        run_consultation(app, i, dialogues[i % len(dialogues)], semaphore, args.think_time, turn_latencies)
+        for i in range(args.consultations)
+    ])
+    elapsed = time.perf_counter() - started
+
+    sessions = [app.session_store.get(f"loadtest-{i}") for i in range(args.consultations)]
+    # 產品目錄由所有會話共用，不計入單一會話的記憶體
+    session_bytes = [deep_sizeof({k: v for k, v in s.items() if k != "catalog"}) for s in sessions]
+    turns = sum(r["turns"] for r in results)
+    prompt_tokens = app.PROMPT_TOKENS.total() - prompt_before
+    cached_tokens = app.CACHED_PROMPT_TOKENS.total() - cached_before
+    completion_tokens = app.COMPLETION_TOKENS.total() - completion_before
+
+    return {
+        "consultations": args.consultations,
+        "concurrency": args.concurrency,
+        "turns": turns,
+        "errors": sum(r["errors"] for r in results),
+        "degraded": sum(r["degraded"] for r in results),
+        "openai_retries": app.OPENAI_RETRIES.total(),
+        "openai_hedges": app.OPENAI_HEDGES.total(),
+        "duration_seconds": round(elapsed, 3),
+        "requests_per_second": round(turns / elapsed, 2) if elapsed else None,
+        "turn_latency_seconds": {
+            "p50": percentile(turn_latencies, 50),
+            "p95": percentile(turn_latencies, 95),
+            "p99": percentile(turn_latencies, 99),
+            "max": round(max(turn_latencies), 4) if turn_latencies else None,
+        },
+        "memory_per_session_bytes": round(sum(session_bytes) / len(session_bytes)) if session_bytes else None,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "tokens_per_consultation": {
+            "prompt": round(prompt_tokens / args.consultations, 1),
+            "cached_prompt": round(cached_tokens / args.consultations, 1),
+            "completion": round(completion_tokens / args.consultations, 1),
+        },
+        "prompt_cache_hit_ratio": round(cached_tokens / prompt_tokens, 4) if prompt_tokens else None,
+        "cost_per_consultation_usd": round((app.API_COST.total() - cost_before) / args.consultations, 6),
+        "final_steps": {str(step): sum(1 for r in results if r["final_step"] == step)
+                        for step in sorted({r["final_step"] for r in results})},
+    }
+
+
+def check_gates(report, args):
+    """依門檻及基準報告判斷是否通過，回傳未通過的項目"""
+    failures = []
+    p95 = report["turn_latency_seconds"]["p95"]
+    if args.max_p95 is not None and p95 is not None and p95 > args.max_p95:
+        failures.append(f"p95 {p95:.3f}s 超過上限 {args.max_p95}s")
+    if args.min_rps is not None and report["requests_per_second"] < args.min_rps:
+        failures.append(f"RPS {report['requests_per_second']} 低於下限 {args.min_rps}")
+    if report["errors"] > args.max_errors:
+        failures.append(f"錯誤數 {report['errors']} 超過上限 {args.max_errors}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        tolerance = 1 + args.max_regression
+        base_p95 = baseline["turn_latency_seconds"]["p95"]
+        if base_p95 and p95 > base_p95 * tolerance:
+            failures.append(f"p95 {p95:.3f}s 較基準 {base_p95:.3f}s 退步超過 {args.max_regression:.0%}")
+        if report["requests_per_second"] * tolerance < baseline["requests_per_second"]:
+            failures.append(f"RPS {report['requests_per_second']} 較基準 {baseline['requests_per_second']} 退步超過 {args.max_regression:.0%}")
+        base_tokens = baseline["tokens_per_consultation"]["prompt"]
+        if base_tokens and report["tokens_per_consultation"]["prompt"] > base_tokens * tolerance:
+            failures.append(f"每段對話輸入 tokens {report['tokens_per_consultation']['prompt']} 較基準 {base_tokens} 增加超過 {args.max_regression:.0%}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以模擬 OpenAI 伺服器對推薦系統進行壓力測試")
+    parser.add_argument("--consultations", type=int, default=100, help="模擬的對話數")
+    parser.add_argument("--concurrency", type=int, default=50, help="同時進行的對話數")
+    parser.add_argument("--script", help="對話腳本 JSON 檔（用戶消息列表的列表），預設使用內建腳本")
+    parser.add_argument("--think-time", type=float, default=0.0, help="每輪之間隨機等待的最長秒數")
+    parser.add_argument("--latency", type=float, default=0.5, help="模擬伺服器第一個區塊前的延遲秒數")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="模擬伺服器串流區塊之間的延遲秒數")
+    parser.add_argument("--reply-chars", type=int, default=0, help="模擬回覆補齊到此長度")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模擬伺服器回應 500 的請求比例")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="模擬伺服器回應 429 的請求比例")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="模擬伺服器額外延遲的請求比例")
+    parser.add_argument("--slow-latency", type=float, default=5.0, help="額外延遲的秒數")
+    parser.add_argument("--api-base", help="使用已啟動的 OpenAI 相容伺服器，不啟動模擬伺服器")
+    parser.add_argument("--output", help="報告寫入此檔案，預設輸出到標準輸出")
+    parser.add_argument("--max-p95", type=float, help="p95 延遲上限（秒）")
+    parser.add_argument("--min-rps", type=float, help="每秒請求數下限")
+    parser.add_argument("--max-errors", type=int, default=0, help="允許的錯誤回覆數")
+    parser.add_argument("--baseline", help="與此基準報告比較")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="相對基準允許的退步比例")
+    parser.add_argument("--verbose", action="store_true", help="輸出 app.py 的 INFO 日誌")
+    args = parser.parse_args()
+
+    dialogues = DEFAULT_DIALOGUES
+    if args.script:
+        with open(args.script, encoding="utf-8") as f:
+            dialogues = json.load(f)
+
+    mock_process = None
+    api_base = args.api_base
+    if not api_base:
+        mock_process, api_base = start_mock_server(args)
+
+    # app.py 在匯入時讀取設定；模擬伺服器不限流，預設放寬 RPM/TPM 以測量程式本身的吞吐量
+    os.environ["OPENAI_API_BASE"] = api_base
+    os.environ.setdefault("OPENAI_API_KEY", "loadtest")
+    os.environ.setdefault("OPENAI_RPM_LIMIT", "1000000")
+    os.environ.setdefault("OPENAI_TPM_LIMIT", "1000000000")
+    os.environ.setdefault("LOG_DETAIL_SAMPLE_RATE", "0")
+    os.environ.setdefault("SESSION_MAX_COUNT", str(max(args.consultations, 1000)))
+    try:
+        import logging
+        import app
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+
+        report = asyncio.run(run_load_test(app, args, dialogues))
+        failures = check_gates(report, args)
+        report["gate"] = {"passed": not failures, "failures": failures}
+
+        output = json.dumps(report, ensure_ascii=False, indent=2)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(output + "\n")
+        print(output)
+        sys.exit(1 if failures else 0)
+    finally:
+        if mock_process:
+            mock_process.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""本地模擬的 OpenAI Chat Completions 伺服器，供壓力測試使用，不產生 API 費用
+
+python mock_openai.py --port 8899 --latency 0.5 --token-delay 0.01
+然後以 OPENAI_API_BASE=http://127.0.0.1:8899/v1 啟動 app.py 或 loadtest.py
+
+故障注入：--error-rate（回應 500）、--rate-limit-rate（回應 429 並帶 Retry-After）、--slow-rate（額外延遲 --slow-latency 秒）、
+--stall-rate（串流送出部分內容後停止）；執行中可 POST /faults 調整，例如 {"error_rate": 1.0} 模擬上游中斷。
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+
+from aiohttp import web
+
+# 依用戶消息數依序回覆，內容帶有推薦流程各步驟的用語，讓 app.py 的流程狀態能正常推進
+SCRIPTED_REPLIES = [
+    "聽起來您可能在尋找與『居家安全監控』相關的產品，這類產品通常用於偵測跌倒、異常離床或提供緊急呼叫功能。請問這個方向是您想要的嗎？",
+    "為了更精確地推薦，請問您：\n1. 比較重視『自動偵測並發出警報』，還是『主動求助』的功能？\n2. 對於安裝方式（固定式或穿戴式）您有特別偏好嗎？",
+    "好的，讓我整理一下您的需求：\n- 第一層分類：『居家安全監控』\n- 特別需求：自動偵測跌倒\n- 偏好：非穿戴式設備\n請問我的理解正確嗎？",
+    "以下是為您推薦的產品：\n1. 產品名稱：模擬跌倒偵測器\n   公司名稱：模擬科技\n   主要功能與特色：自動偵測跌倒並通知家屬\n"
+    "   產品網址：https://example.com/product\n   廠商連絡電話：02-1234-5678\n\n請問以上推薦的產品是否符合您的期待？",
+]
+
+
+# 與 OpenAI 提示詞快取相同：前綴至少 1024 tokens 才會快取，命中部分以 128 tokens 為單位
+CACHE_MIN_TOKENS = 1024
+CACHE_INCREMENT = 128
+
+
+def estimate_tokens(text, chars_per_token):
+    return max(1, int(len(text) / chars_per_token))
+
+
+FAULT_FIELDS = ("error_rate", "rate_limit_rate", "retry_after", "slow_rate", "slow_latency", "stall_rate")
+
+
+class MockOpenAI:
+    """依設定的延遲與 tokens 用量回應 /v1/chat/completions，並可依比例注入錯誤、限流、延遲與串流中斷"""
+
+    def __init__(self, latency=0.5, token_delay=0.01, chunk_chars=4, chars_per_token=1.0,
+                 reply_chars=0, completion_tokens=None, error_rate=0.0, rate_limit_rate=0.0, retry_after=1.0,
+                 slow_rate=0.0, slow_latency=5.0, stall_rate=0.0, seed=None):
+        self.latency = latency
+        self.token_delay = token_delay
+        self.chunk_chars = chunk_chars
+        self.chars_per_token = chars_per_token
+        self.reply_chars = reply_chars
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.stall_rate = stall_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.faults = {"errors": 0, "rate_limited": 0, "slow": 0, "stalled": 0}
+        self.cached_prefixes = set()
+        self.started_at = time.time()
+
+    def make_reply(self, messages):
+        user_turns = sum(1 for m in messages if m["role"] == "user")
+        reply = SCRIPTED_REPLIES[min(user_turns, len(SCRIPTED_REPLIES)) - 1]
+        if self.reply_chars > len(reply):
+            reply += "。" * (self.reply_chars - len(reply))
+        return reply
+
+    def cached_tokens(self, messages, message_tokens):
+        """以消息為單位找出先前請求出現過的最長前綴，模擬供應商的提示詞快取"""
+        digest = hashlib.sha256()
+        prefix_tokens = cached = 0
+        for message, tokens in zip(messages, message_tokens):
+            digest.update(json.dumps([message["role"], message["content"]], ensure_ascii=False).encode())
+            key = digest.hexdigest()
+            prefix_tokens += tokens
+            if key in self.cached_prefixes:
+                cached = prefix_tokens
+            elif prefix_tokens >= CACHE_MIN_TOKENS:
+                self.cached_prefixes.add(key)
+        if cached < CACHE_MIN_TOKENS:
+            return 0
+        return cached - cached % CACHE_INCREMENT
+
+    def make_usage(self, messages, reply):
+        message_tokens = [estimate_tokens(m["content"], self.chars_per_token) + 3 for m in messages]
+        prompt_tokens = sum(message_tokens) + 3
+        completion_tokens = self.completion_tokens or estimate_tokens(reply, self.chars_per_token)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": self.cached_tokens(messages, message_tokens)},
+        }
+
+    def error_response(self, status, message, headers=None):
+        return web.json_response(
+            {"error": {"message": message, "type": "server_error" if status >= 500 else "rate_limit_exceeded"}},
+            status=status, headers=headers
+        )
+
+    async def chat_completions(self, request):
+        body = await request.json()
+        self.requests += 1
+        messages = body.get("messages", [])
+        model = body.get("model", "mock")
+
+        # 故障注入：依序判斷錯誤、限流，其餘請求可能額外延遲或在串流中途停止
+        roll = self.random.random()
+        if roll < self.error_rate:
+            self.faults["errors"] += 1
+            await asyncio.sleep(self.latency)
+            return self.error_response(500, "mock upstream error")
+        if roll < self.error_rate + self.rate_limit_rate:
+            self.faults["rate_limited"] += 1
+            return self.error_response(429, "mock rate limit", {"Retry-After": str(self.retry_after)})
+        latency = self.latency
+        if self.random.random() < self.slow_rate:
+            self.faults["slow"] += 1
+            latency += self.slow_latency
+        stall = self.random.random() < self.stall_rate
+
+        reply = self.make_reply(messages)
+        usage = self.make_usage(messages, reply)
+        await asyncio.sleep(latency)
+
+        base = {"id": f"chatcmpl-mock-{self.requests}", "created": int(time.time()), "model": model}
+        if not body.get("stream"):
+            return web.json_response({
+                **base,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(payload):
+            await response.write(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode())
+
+        for i in range(0, len(reply), self.chunk_chars):
+            await send({**base, "object": "chat.completion.chunk", "choices": [
+                {"index": 0, "delta": {"content": reply[i:i + self.chunk_chars]}, "finish_reason": None}
+            ]})
+            if stall and i >= len(reply) // 2:
+                # 送出一半內容後不再回應，直到客戶端逾時斷線
+                self.faults["stalled"] += 1
+                await asyncio.sleep(3600)
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+        await send({**base, "object": "chat.completion.chunk", "choices": [
+            {"index": 0, "delta": {}, "finish_reason": "stop"}
+        ]})
+        if (body.get("stream_options") or {}).get("include_usage"):
+            await send({**base, "object": "chat.completion.chunk", "choices": [], "usage": usage})
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def stats(self, request):
+        elapsed = time.time() - self.started_at
+        return web.json_response({"requests": self.requests, "faults": self.faults, "uptime": round(elapsed, 3)})
+
+    async def update_faults(self, request):
+        """執行中調整故障注入比例，回傳目前設定"""
+        body = await request.json()
+        for field in FAULT_FIELDS:
+            if field in body:
+                setattr(self, field, float(body[field]))
+        return web.json_response({field: getattr(self, field) for field in FAULT_FIELDS})
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_get("/stats", self.stats)
+        app.router.add_post("/faults", self.update_faults)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模擬的 OpenAI Chat Completions 伺服器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8899)
+    parser.add_argument("--latency", type=float, default=0.5, help="第一個區塊前的延遲秒數")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="串流區塊之間的延遲秒數")
+    parser.add_argument("--chunk-chars", type=int, default=4, help="每個串流區塊的字元數")
+    parser.add_argument("--chars-per-token", type=float, default=1.0, help="估算 usage 時每個 token 的字元數")
+    parser.add_argument("--reply-chars", type=int, default=0, help="回覆補齊到此長度")
+    parser.add_argument("--completion-tokens", type=int, default=None, help="固定回報的輸出 tokens")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="回應 500 的請求比例")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="回應 429 的請求比例")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="429 回應的 Retry-After 秒數")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="額外延遲的請求比例")
+    parser.add_argument("--slow-latency", type=float, default=5.0, help="額外延遲的秒數")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="串流送出一半後停止的請求比例")
+    parser.add_argument("--seed", type=int, default=None, help="故障注入的隨機種子")
+    args = parser.parse_args()
+
+    mock = MockOpenAI(
+        latency=args.latency, token_delay=args.token_delay, chunk_chars=args.chunk_chars,
+        chars_per_token=args.chars_per_token, reply_chars=args.reply_chars,
+        completion_tokens=args.completion_tokens, error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after, slow_rate=args.slow_rate,
+        slow_latency=args.slow_latency, stall_rate=args.stall_rate, seed=args.seed
+    )
+    web.run_app(mock.create_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+"""多進程部署：父進程先建立產品目錄快照並恢復待寄郵件，再以 uvicorn 啟動多個 worker 共用同一個埠
+
+python serve.py --workers 4 --port 7860
+worker 之間以 SQLite 會話資料庫（SESSION_DB_PATH，預設 sessions.db）共用會話，任一 worker 都能處理同一個會話的下一輪。
+"""
+import argparse
+import os
+
+import uvicorn
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以多個 worker 進程啟動推薦系統")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", 0)) or os.cpu_count(),
+                        help="worker 進程數，預設為 WEB_CONCURRENCY 或 CPU 核心數")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", 7860)))
+    args = parser.parse_args()
+
+    # worker 以 spawn 啟動並繼承環境變數，app.py 依 WEB_CONCURRENCY 切換為共用會話存儲
+    os.environ["WEB_CONCURRENCY"] = str(args.workers)
+
+    # 在父進程匯入一次：解析 Excel 並寫入快照，worker 啟動時直接讀取快照；同時建立會話資料庫的資料表
+    import app
+    # 上次執行留下的待寄郵件由父進程寄送，worker 只寄送自己排入的郵件
+    app.email_outbox.start()
+    if args.workers == 1:
+        # 單一 worker 在此進程中執行，由這裡啟動產品目錄監看
+        app.start_catalog_watcher()
+
+    uvicorn.run("app:web_app", host=args.host, port=args.port, workers=args.workers,
+                timeout_keep_alive=app.HTTP_KEEP_ALIVE)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+# app.py 在匯入時讀取設定並開啟日誌檔，測試不寫入專案中的 app.log
+os.environ.setdefault("LOG_FILE", os.path.join(tempfile.mkdtemp(prefix="app-test-"), "app.log"))
+os.environ.setdefault("OPENAI_API_KEY", "test")
@@ -0,0 +1,68 @@
+"""CatalogMatcher 的 Aho-Corasick 比對與逐一搜尋的結果一致"""
+import random
+
+import app
+
+
+def make_product(product_id, name, category, subcategory):
+    return app.Product(product_id, name, "測試公司", None, None, None, None, category, subcategory)
+
+
+def brute_force_find_all(products, text):
+    """對每個模式逐一以 str.find 找出所有出現位置"""
+    patterns = []
+    seen = set()
+    for product in products:
+        for kind, pattern, value in (("category", product.category, product.category),
+                                     ("subcategory", product.subcategory, product.subcategory),
+                                     ("product", product.name, product.id)):
+            if pattern is None or (kind, value) in seen:
+                continue
+            seen.add((kind, value))
+            pattern = str(pattern).strip()
+            if pattern:
+                patterns.append((kind, value, pattern))
+    matches = []
+    for kind, value, pattern in patterns:
+        start = text.find(pattern)
+        while start != -1:
+            matches.append((start + len(pattern), kind, value, len(pattern)))
+            start = text.find(pattern, start + 1)
+    return sorted(matches)
+
+
+def random_catalog(rng, alphabet, size):
+    words = lambda: "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 4)))
+    categories = [words() for _ in range(4)]
+    return [make_product(i, words(), rng.choice(categories), words()) for i in range(size)]
+
+
+def test_find_all_matches_brute_force():
+    rng = random.Random(0)
+    # 小字母表讓模式互相重疊、共用前綴與後綴
+    alphabet = "照顧輪椅跌倒"
+    for _ in range(50):
+        products = random_catalog(rng, alphabet, rng.randint(1, 30))
+        matcher = app.CatalogMatcher(products)
+        for _ in range(10):
+            text = "".join(rng.choice(alphabet + "，。 ") for _ in range(rng.randint(0, 60)))
+            assert sorted(matcher.find_all(text)) == brute_force_find_all(products, text)
+
+
+def test_scan_prefers_longer_product_names():
+    products = [
+        make_product(0, "輪椅", "行動輔具", "輪椅"),
+        make_product(1, "電動輪椅", "行動輔具", "輪椅"),
+        make_product(2, "跌倒偵測器", "居家安全監控", "偵測"),
+    ]
+    found = app.CatalogMatcher(products).scan("推薦：電動輪椅，另外也可以搭配跌倒偵測器，屬於居家安全監控")
+    assert found["product"] == [1, 2]
+    assert found["category"] == ["居家安全監控"]
+
+
+def test_state_round_trip():
+    products = random_catalog(random.Random(1), "照顧輪椅跌倒", 20)
+    matcher = app.CatalogMatcher(products)
+    restored = app.CatalogMatcher.from_state(matcher.get_state())
+    text = "照顧輪椅跌倒照顧輪椅" * 3
+    assert restored.find_all(text) == matcher.find_all(text)
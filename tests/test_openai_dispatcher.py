@@ -0,0 +1,184 @@
+"""OpenAIDispatcher 的逾時、重試、對沖與斷路器，對同一事件循環中的 mock_openai.py 執行"""
+import asyncio
+import time
+
+import openai
+import pytest
+from aiohttp import web
+
+import app
+from mock_openai import MockOpenAI
+
+MESSAGES = [{"role": "system", "content": "x"}, {"role": "user", "content": "你好"}]
+
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch):
+    monkeypatch.setattr(app, "OPENAI_TIMEOUT", 2.0)
+    monkeypatch.setattr(app, "OPENAI_MAX_RETRIES", 2)
+    monkeypatch.setattr(app, "OPENAI_RETRY_BASE_DELAY", 0.01)
+    monkeypatch.setattr(app, "OPENAI_RETRY_MAX_DELAY", 0.05)
+    monkeypatch.setattr(app, "OPENAI_HEDGE", False)
+    monkeypatch.setattr(app, "OPENAI_BREAKER_THRESHOLD", 2)
+    monkeypatch.setattr(app, "OPENAI_BREAKER_COOLDOWN", 60.0)
+    monkeypatch.setattr(openai, "api_base", openai.api_base)
+
+
+def run_with_mock(scenario, max_concurrency=10, **mock_options):
+    """啟動模擬伺服器與新的調度器後執行 scenario(mock, dispatcher)"""
+    async def main():
+        mock = MockOpenAI(**{"latency": 0.05, "token_delay": 0, "seed": 0, **mock_options})
+        runner = web.AppRunner(mock.create_app(), shutdown_timeout=0.1)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        openai.api_base = f"http://127.0.0.1:{port}/v1"
+        dispatcher = app.OpenAIDispatcher(max_concurrency, 1000000, 1000000000)
+        try:
+            return await scenario(mock, dispatcher)
+        finally:
+            if dispatcher._http_session is not None:
+                await dispatcher._http_session.close()
+            await runner.cleanup()
+    return asyncio.run(main())
+
+
+async def open_breaker(dispatcher):
+    for _ in range(app.OPENAI_BREAKER_THRESHOLD):
+        with pytest.raises(app.OpenAIUnavailableError):
+            await dispatcher.create(model="mock", messages=MESSAGES)
+    assert dispatcher.breaker.is_open()
+
+
+def test_rate_limit_retried_after_retry_after():
+    async def scenario(mock, dispatcher):
+        retries = app.OPENAI_RETRIES.total()
+        started = time.monotonic()
+        call = asyncio.ensure_future(dispatcher.create(model="mock", messages=MESSAGES))
+        await asyncio.sleep(0.1)
+        mock.rate_limit_rate = 0.0
+        response = await call
+        assert response["choices"][0]["message"]["content"]
+        assert time.monotonic() - started >= 0.3
+        assert app.OPENAI_RETRIES.total() == retries + 1
+        assert mock.faults["rate_limited"] == 1
+        assert not dispatcher.breaker.failures
+
+    run_with_mock(scenario, rate_limit_rate=1.0, retry_after=0.3)
+
+
+def test_local_queueing_is_not_an_upstream_timeout(monkeypatch):
+    monkeypatch.setattr(app, "OPENAI_TIMEOUT", 0.5)
+
+    async def scenario(mock, dispatcher):
+        retries = app.OPENAI_RETRIES.total()
+        # 只有一個並發名額，後面的呼叫在本地排隊超過逾時秒數
+        await asyncio.gather(*[dispatcher.create(model="mock", messages=MESSAGES) for _ in range(4)])
+        assert app.OPENAI_RETRIES.total() == retries
+        assert mock.requests == 4
+        assert not dispatcher.breaker.failures
+        assert max(dispatcher._latencies[False]) < 0.5
+
+    run_with_mock(scenario, max_concurrency=1, latency=0.3)
+
+
+def test_stalled_stream_times_out(monkeypatch):
+    monkeypatch.setattr(app, "OPENAI_TIMEOUT", 0.3)
+
+    async def scenario(mock, dispatcher):
+        chunks = []
+        with pytest.raises(app.OpenAIUnavailableError):
+            async for chunk in dispatcher.stream(model="mock", messages=MESSAGES):
+                chunks.append(chunk)
+        assert chunks
+        assert mock.faults["stalled"] == 1
+        assert dispatcher.in_flight == 0
+
+    run_with_mock(scenario, stall_rate=1.0)
+
+
+def test_breaker_opens_and_fails_fast(monkeypatch):
+    monkeypatch.setattr(app, "OPENAI_MAX_RETRIES", 0)
+
+    async def scenario(mock, dispatcher):
+        await open_breaker(dispatcher)
+        requests = mock.requests
+        with pytest.raises(app.OpenAIUnavailableError):
+            await dispatcher.create(model="mock", messages=MESSAGES)
+        assert mock.requests == requests
+
+    run_with_mock(scenario, error_rate=1.0)
+
+
+def test_breaker_closes_after_successful_trial(monkeypatch):
+    monkeypatch.setattr(app, "OPENAI_MAX_RETRIES", 0)
+    monkeypatch.setattr(app, "OPENAI_BREAKER_COOLDOWN", 0.2)
+
+    async def scenario(mock, dispatcher):
+        await open_breaker(dispatcher)
+        mock.error_rate = 0.0
+        await asyncio.sleep(0.25)
+        assert await dispatcher.create(model="mock", messages=MESSAGES)
+        assert dispatcher.breaker.opened_at is None
+
+    run_with_mock(scenario, error_rate=1.0)
+
+
+def test_trial_released_when_stream_closed_early(monkeypatch):
+    monkeypatch.setattr(app, "OPENAI_MAX_RETRIES", 0)
+    monkeypatch.setattr(app, "OPENAI_BREAKER_COOLDOWN", 0.2)
+
+    async def scenario(mock, dispatcher):
+        await open_breaker(dispatcher)
+        mock.error_rate = 0.0
+        await asyncio.sleep(0.25)
+        stream = dispatcher.stream(model="mock", messages=MESSAGES)
+        await stream.__anext__()
+        await stream.aclose()
+        assert not dispatcher.breaker.trial
+        assert await dispatcher.create(model="mock", messages=MESSAGES)
+        assert dispatcher.breaker.opened_at is None
+
+    run_with_mock(scenario, error_rate=1.0)
+
+
+def test_trial_released_when_cancelled(monkeypatch):
+    monkeypatch.setattr(app, "OPENAI_MAX_RETRIES", 0)
+    monkeypatch.setattr(app, "OPENAI_BREAKER_COOLDOWN", 0.2)
+
+    async def scenario(mock, dispatcher):
+        await open_breaker(dispatcher)
+        mock.error_rate = 0.0
+        mock.latency = 1.0
+        await asyncio.sleep(0.25)
+        call = asyncio.ensure_future(dispatcher.create(model="mock", messages=MESSAGES))
+        await asyncio.sleep(0.1)
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call
+        assert not dispatcher.breaker.trial
+        mock.latency = 0.05
+        assert await dispatcher.create(model="mock", messages=MESSAGES)
+        assert dispatcher.in_flight == 0
+
+    run_with_mock(scenario, error_rate=1.0)
+
+
+def test_hedge_answers_slow_request(monkeypatch):
+    monkeypatch.setattr(app, "OPENAI_HEDGE", True)
+    monkeypatch.setattr(app, "OPENAI_HEDGE_MIN_DELAY", 0.1)
+
+    async def scenario(mock, dispatcher):
+        dispatcher._latencies[False].extend([0.05] * dispatcher.HEDGE_MIN_SAMPLES)
+        hedges = app.OPENAI_HEDGES.total()
+        started = time.monotonic()
+        call = asyncio.ensure_future(dispatcher.create(model="mock", messages=MESSAGES))
+        await asyncio.sleep(0.05)
+        mock.slow_rate = 0.0  # 只有第一個請求變慢
+        assert await call
+        assert time.monotonic() - started < 1.0
+        assert app.OPENAI_HEDGES.total() == hedges + 1
+        assert dispatcher.in_flight == 0
+
+    run_with_mock(scenario, slow_rate=1.0, slow_latency=2.0)
@@ -0,0 +1,68 @@
+"""ProductIndex 的 BM25 檢索"""
+import math
+
+import pytest
+
+import app
+
+
+def make_product(product_id, name, function, category, subcategory="其他"):
+    return app.Product(product_id, name, "測試公司", None, None, function, None, category, subcategory)
+
+
+PRODUCTS = [
+    make_product(0, "夜間離床感應墊", "長輩夜間離床時通知家人", "居家安全監控"),
+    make_product(1, "跌倒偵測雷達", "非穿戴式自動偵測跌倒並發出警報", "居家安全監控"),
+    make_product(2, "智慧血壓計", "量測血壓並上傳給醫師", "健康量測"),
+    make_product(3, "緊急求助手環", "穿戴式一鍵求助，偵測跌倒", "緊急求助"),
+    make_product(4, "電動輪椅", "折疊輕便，適合外出", "行動輔具"),
+]
+
+
+def brute_force_scores(products, query, k1=1.5, b=0.75):
+    """逐一產品計算的 BM25 分數，作為倒排表實作的對照"""
+    docs = [app.tokenize_ngrams(" ".join(str(p.get(col, "")) for col in app.RETRIEVAL_COLUMNS)) for p in products]
+    avg_length = sum(len(doc) for doc in docs) / len(docs)
+    scores = []
+    for doc in docs:
+        score = 0.0
+        for term in set(app.tokenize_ngrams(query)):
+            tf = doc.count(term)
+            if not tf:
+                continue
+            doc_freq = sum(1 for other in docs if term in other)
+            idf = math.log(1 + (len(docs) - doc_freq + 0.5) / (doc_freq + 0.5))
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(doc) / avg_length))
+        scores.append(score)
+    return scores
+
+
+@pytest.fixture(scope="module")
+def index():
+    return app.ProductIndex(PRODUCTS)
+
+
+def test_most_relevant_product_first(index):
+    assert index.search("長輩跌倒時能自動偵測", 3)[0] == 1
+    assert index.search("想量血壓", 3)[0] == 2
+
+
+def test_ranking_matches_brute_force_bm25(index):
+    query = "家中長輩晚上常跌倒，想找不用穿戴、能自動偵測並通知家人的設備"
+    scores = brute_force_scores(PRODUCTS, query)
+    expected = sorted((i for i, score in enumerate(scores) if score > 0), key=lambda i: -scores[i])
+    assert index.search(query, len(PRODUCTS)) == expected
+    assert index.search(query, 2) == expected[:2]
+
+
+def test_category_filter_and_min_score(index):
+    results = index.search("偵測跌倒", 5, category="緊急求助")
+    assert results == [3]
+    assert index.search("偵測跌倒", 5, min_score=1000) == []
+    assert index.search("完全無關的詞zzz", 5) == []
+
+
+def test_state_round_trip(index):
+    restored = app.ProductIndex.from_state(PRODUCTS, index.get_state())
+    query = "夜間離床通知"
+    assert restored.search(query, 5) == index.search(query, 5)
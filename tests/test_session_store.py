@@ -0,0 +1,118 @@
+"""SQLiteSessionBackend 與 SessionStore：保存、重啟後載入與多個 worker 之間的版本更新"""
+import asyncio
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "sessions.db")
+
+
+def make_store(db_path, shared=False, flush_interval=0.0, idle_ttl=3600):
+    backend = app.SQLiteSessionBackend(db_path, idle_ttl, flush_interval)
+    return app.SessionStore(60, idle_ttl, 100, backend, shared=shared)
+
+
+def contents(session):
+    return [(m["role"], m["content"]) for m in session["conversation"]]
+
+
+def test_round_trip_after_restart(db_path):
+    store = make_store(db_path)
+    session = store.get("s1")
+    app.append_message(session, "system", "系統提示")
+    app.append_message(session, "user", "長輩夜間常跌倒")
+    app.append_message(session, "assistant", "請問是在家中使用嗎？")
+    session["state"]["step"] = 2
+    session["api_cost"] = 0.0123
+    store.save("s1").wait(5)
+    # 刪減對話後只更新序號列表，已寫入的消息不變
+    app.set_messages(session, 1, 2, [])
+    store.save("s1").wait(5)
+    store.backend.close()
+
+    restarted = make_store(db_path)
+    loaded = restarted.get("s1")
+    assert contents(loaded) == [("system", "系統提示"), ("assistant", "請問是在家中使用嗎？")]
+    assert loaded["state"]["step"] == 2
+    assert loaded["api_cost"] == pytest.approx(0.0123)
+    assert loaded["conversation_tokens"] == session["conversation_tokens"]
+    # 新消息接續原本的序號
+    app.append_message(loaded, "user", "是的")
+    restarted.save("s1").wait(5)
+    restarted.backend.close()
+    assert contents(make_store(db_path).get("s1"))[-1] == ("user", "是的")
+
+
+def test_delete_then_recreate_in_one_batch(db_path):
+    backend = app.SQLiteSessionBackend(db_path, 3600, 0.5)
+    session = app.SessionStore._new_session()
+    app.append_message(session, "user", "OLD-1")
+    backend.save("s1", session).wait(5)
+
+    # 刪除與重新建立落在同一批寫入中，新會話的序號從頭配發
+    backend.delete("s1")
+    session = app.SessionStore._new_session()
+    app.append_message(session, "user", "NEW-1")
+    backend.save("s1", session).wait(5)
+    backend.close()
+
+    assert contents(make_store(db_path).get("s1")) == [("user", "NEW-1")]
+
+
+def test_save_after_cleanup_rewrites_history(db_path):
+    store = make_store(db_path)
+    session = store.get("s1")
+    app.append_message(session, "user", "第一輪")
+    app.append_message(session, "assistant", "回覆")
+    store.save("s1").wait(5)
+
+    # 另一個 worker 的清除刪掉資料庫中的會話，此 worker 仍在記憶體中使用它
+    conn = store.backend._connect()
+    with conn:
+        conn.execute("UPDATE sessions SET updated_at = 0")
+    store.backend._cleanup(conn)
+    conn.close()
+    assert store.backend.load("s1") is None
+
+    app.append_message(session, "user", "第二輪")
+    store.save("s1").wait(5)
+    store.backend.close()
+    assert contents(make_store(db_path).get("s1")) == [("user", "第一輪"), ("assistant", "回覆"), ("user", "第二輪")]
+
+
+def test_shared_store_reloads_newer_revision(db_path):
+    worker_a = make_store(db_path, shared=True)
+    worker_b = make_store(db_path, shared=True)
+    session = worker_a.get("s1")
+    app.append_message(session, "user", "第一輪")
+    worker_a.save("s1").wait(5)
+    assert contents(worker_b.get("s1")) == [("user", "第一輪")]
+
+    # worker A 處理下一輪後，worker B 記憶體中的會話已過期
+    app.append_message(session, "assistant", "回覆")
+    app.append_message(session, "user", "第二輪")
+    worker_a.save("s1").wait(5)
+    reloaded = worker_b.get("s1")
+    assert contents(reloaded) == [("user", "第一輪"), ("assistant", "回覆"), ("user", "第二輪")]
+    assert reloaded["revision"] == session["revision"]
+
+
+def test_fetch_refreshes_and_get_without_refresh_uses_memory(db_path):
+    worker_a = make_store(db_path, shared=True)
+    worker_b = make_store(db_path, shared=True)
+    session = worker_a.get("s1")
+    app.append_message(session, "user", "第一輪")
+    worker_a.save("s1").wait(5)
+    assert contents(asyncio.run(worker_b.fetch("s1"))) == [("user", "第一輪")]
+
+    app.append_message(session, "user", "第二輪")
+    worker_a.save("s1").wait(5)
+    # 同一輪稍後的取用不再查詢資料庫
+    assert contents(worker_b.get("s1", refresh=False)) == [("user", "第一輪")]
+    assert contents(asyncio.run(worker_b.fetch("s1"))) == [("user", "第一輪"), ("user", "第二輪")]
+    assert asyncio.run(worker_b.contains("s1"))
+    assert not asyncio.run(worker_b.contains("s2"))
@@ -0,0 +1,82 @@
+"""SingleFlight：同一會話重複送出的輸入共用結果，不同輸入依序處理"""
+import asyncio
+
+import pytest
+
+import app
+
+
+def make_turn(calls, reply, delay=0.05, fail=False):
+    """記錄開始與結束順序的回合，產生兩段累積的回覆"""
+    async def turn():
+        calls.append(("start", reply))
+        await asyncio.sleep(delay)
+        yield reply[:1]
+        if fail:
+            raise RuntimeError("連線中斷")
+        await asyncio.sleep(delay)
+        yield reply
+        calls.append(("end", reply))
+    return turn
+
+
+async def collect(flight, session_id, user_input, turn):
+    replies = []
+    async for reply in flight.run(session_id, user_input, turn):
+        replies.append(reply)
+    return replies
+
+
+def test_duplicate_submissions_share_one_turn():
+    async def main():
+        flight = app.SingleFlight()
+        calls = []
+        coalesced = app.TURNS_COALESCED.total()
+        first = asyncio.ensure_future(collect(flight, "s1", "你好", make_turn(calls, "回覆一")))
+        await asyncio.sleep(0.01)
+        assert flight.pending("s1", "你好！")
+        # 連按兩次 Enter：正規化後相同的輸入不再呼叫 turn
+        second = await collect(flight, "s1", " 你好！ ", make_turn(calls, "不應執行"))
+        assert second == ["回覆一"]
+        assert await first == ["回", "回覆一"]
+        assert calls == [("start", "回覆一"), ("end", "回覆一")]
+        assert app.TURNS_COALESCED.total() == coalesced + 1
+        assert len(flight) == 0 and not flight._locks
+
+    asyncio.run(main())
+
+
+def test_different_inputs_run_in_order():
+    async def main():
+        flight = app.SingleFlight()
+        calls = []
+        queued = app.TURNS_QUEUED.total()
+        results = await asyncio.gather(
+            collect(flight, "s1", "第一題", make_turn(calls, "答一")),
+            collect(flight, "s1", "第二題", make_turn(calls, "答二")),
+            collect(flight, "s2", "第一題", make_turn(calls, "別的會話")),
+        )
+        assert [replies[-1] for replies in results] == ["答一", "答二", "別的會話"]
+        # 同一會話的回合不重疊，其他會話不必等待
+        session_calls = [call for call in calls if call[1] != "別的會話"]
+        assert session_calls == [("start", "答一"), ("end", "答一"), ("start", "答二"), ("end", "答二")]
+        assert calls.index(("start", "別的會話")) < calls.index(("end", "答一"))
+        assert app.TURNS_QUEUED.total() == queued + 1
+        assert len(flight) == 0 and not flight._locks
+
+    asyncio.run(main())
+
+
+def test_waiting_duplicate_gets_error_when_turn_fails():
+    async def main():
+        flight = app.SingleFlight()
+        calls = []
+        first = asyncio.ensure_future(collect(flight, "s1", "你好", make_turn(calls, "回覆一", fail=True)))
+        await asyncio.sleep(0.01)
+        second = await collect(flight, "s1", "你好", make_turn(calls, "不應執行"))
+        assert second == ["抱歉，系統暫時無法處理您的請求，請稍後再試。"]
+        with pytest.raises(RuntimeError):
+            await first
+        assert len(flight) == 0 and not flight._locks
+
+    asyncio.run(main())